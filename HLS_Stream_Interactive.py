@@ -4,14 +4,28 @@ import subprocess
 import sys
 import urllib.request
 import urllib.parse
+import urllib.error
 import time
 import hashlib
+import datetime
+import collections
+import json
+import io
 import shutil # 用于处理临时目录和文件移动
 import concurrent.futures # 新增导入
 import asyncio # 用于异步下载
 import threading
+import heapq
+import bisect
+import random
+import queue
 
-# --- 阿里云直播鉴权函数 (A 类鉴权) ---
+# --- 阿里云直播鉴权函数 (A/B/C 类鉴权) ---
+
+# 预编译的鉴权 URL 解析正则: (scheme)(host)(path)(args)
+AUTH_URI_PATTERN = re.compile(r"^(rtmp://|https?://)?([^/?]+)(/[^?]*)?(\?.*)?$")
+# B 类鉴权的时间戳使用北京时间 (UTC+8)
+AUTH_TZ_UTC8 = datetime.timezone(datetime.timedelta(hours=8))
 
 def md5sum(src):
     """计算字符串的 MD5 哈希值"""
@@ -19,6 +33,46 @@ def md5sum(src):
     m.update(src)
     return m.hexdigest()
 
+def split_auth_uri(uri, default_scheme="rtmp://"):
+    """
+    将鉴权 URL 拆分为 (scheme, host, path, args)，缺省部分补默认值。
+    无法解析时返回 None。
+    """
+    m = AUTH_URI_PATTERN.match(uri)
+    if not m:
+        return None
+    scheme, host, path, args = m.groups()
+    return scheme or default_scheme, host, path or "/", args or ""
+
+def sign_auth_parts(parts, key, exp, auth_type="A", ttl=1800, rand="0", uid="0"):
+    """
+    对已拆分的 URL 进行阿里云鉴权签名，返回签名后的完整 URL。
+
+    参数:
+        parts: split_auth_uri 的返回值
+        key: 鉴权主 KEY
+        exp: URL 失效时间的 UNIX 时间戳 (秒)
+        auth_type: "A" / "B" / "C"
+        ttl: 控制台配置的鉴权有效时长 (秒)，仅 B/C 类使用。
+             B/C 类 URL 中携带的是签发时间，服务端按 签发时间 + ttl 判定过期，
+             因此这里以 exp - ttl 作为签发时间。
+    """
+    scheme, host, path, args = parts
+    if auth_type == "A":
+        hashvalue = md5sum(f"{path}-{exp}-{rand}-{uid}-{key}".encode('utf-8'))
+        auth_key = f"{exp}-{rand}-{uid}-{hashvalue}"
+        return f"{scheme}{host}{path}{args}{'&' if args else '?'}auth_key={auth_key}"
+    if auth_type == "B":
+        # B 类时间戳精度为分钟 (YYYYMMDDHHMM)
+        timestamp = datetime.datetime.fromtimestamp(exp - ttl, AUTH_TZ_UTC8).strftime("%Y%m%d%H%M")
+        hashvalue = md5sum(f"{key}{timestamp}{path}".encode('utf-8'))
+        return f"{scheme}{host}/{timestamp}/{hashvalue}{path}{args}"
+    if auth_type == "C":
+        timestamp = format(int(exp - ttl), 'x')
+        hashvalue = md5sum(f"{key}{path}{timestamp}".encode('utf-8'))
+        return f"{scheme}{host}/{hashvalue}/{timestamp}{path}{args}"
+    raise ValueError(f"不支持的鉴权类型: {auth_type}")
+
 def a_auth(uri, key, exp):
     """
     生成阿里云视频直播 A 类鉴权的 URL。
@@ -31,25 +85,79 @@ def a_auth(uri, key, exp):
     返回:
         带 auth_key 参数的完整推流 URL
     """
-    p = re.compile(r"^(rtmp://)?([^/?]+)(/[^?]*)?(\?.*)?$")
-    if not p:
+    parts = split_auth_uri(uri)
+    if parts is None:
         return None
-    m = p.match(uri)
-    scheme, host, path, args = m.groups()
-    if not scheme: scheme = "rtmp://"
-    if not path: path = "/"
-    if not args: args = ""
-    
-    rand = "0"      # "0" by default, other value is ok
-    uid = "0"       # "0" by default, other value is ok
-    sstring = "%s-%s-%s-%s-%s" % (path, exp, rand, uid, key)
-    hashvalue = md5sum(sstring.encode('utf-8'))
-    auth_key = "%s-%s-%s-%s" % (exp, rand, uid, hashvalue)
-    
-    if args:
-        return "%s%s%s%s&auth_key=%s" % (scheme, host, path, args, auth_key)
-    else:
-        return "%s%s%s%s?auth_key=%s" % (scheme, host, path, args, auth_key)
+    return sign_auth_parts(parts, key, exp, "A")
+
+class UrlSigner:
+    """
+    高吞吐的阿里云鉴权 URL 签名器，支持 A/B/C 类鉴权以及 rtmp/http/https 地址。
+
+    - sign(uri, exp=...) 按指定失效时间签名；sign(uri, expire_in=...) 按相对有效期签名
+    - 签名结果会被缓存: 按 exp 签名时缓存到失效为止 (同一 exp 的签名结果不变)；
+      按 expire_in 签名时最多复用 expire_in * reuse_ratio 秒，
+      保证返回的 URL 剩余有效期不少于 expire_in * (1 - reuse_ratio)
+    - sign_many() 批量签名，整批只加锁和取时间一次
+    - 线程安全，缓存按 LRU 限制在 max_entries 条以内
+    """
+    def __init__(self, key, auth_type="A", ttl=1800, reuse_ratio=0.1, max_entries=100000,
+                 rand="0", uid="0", default_scheme="rtmp://"):
+        if auth_type not in ("A", "B", "C"):
+            raise ValueError(f"不支持的鉴权类型: {auth_type}")
+        self.key = key
+        self.auth_type = auth_type
+        self.ttl = ttl
+        self.reuse_ratio = reuse_ratio
+        self.max_entries = max_entries
+        self.rand = rand
+        self.uid = uid
+        self.default_scheme = default_scheme
+        
+        self._cache = collections.OrderedDict()  # (uri, exp, expire_in) -> (签名 URL, 可复用截止时间)
+        self._parts = {}                         # uri -> split_auth_uri 结果
+        self._lock = threading.Lock()
+
+    def sign(self, uri, exp=None, expire_in=None):
+        """签名单个 URL，exp 与 expire_in 二选一。无法解析的 URL 返回 None。"""
+        with self._lock:
+            return self._sign_locked(uri, exp, expire_in, time.time())
+
+    def sign_many(self, uris, exp=None, expire_in=None):
+        """批量签名，返回与 uris 一一对应的列表"""
+        with self._lock:
+            now = time.time()
+            return [self._sign_locked(uri, exp, expire_in, now) for uri in uris]
+
+    def _sign_locked(self, uri, exp, expire_in, now):
+        if (exp is None) == (expire_in is None):
+            raise ValueError("exp 与 expire_in 必须且只能提供一个")
+        
+        cache_key = (uri, exp, expire_in)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            if now < cached[1]:
+                self._cache.move_to_end(cache_key)
+                return cached[0]
+            del self._cache[cache_key]
+        
+        parts = self._parts.get(uri)
+        if parts is None:
+            parts = split_auth_uri(uri, self.default_scheme)
+            if parts is None:
+                return None
+            if len(self._parts) >= self.max_entries:
+                self._parts.clear()
+            self._parts[uri] = parts
+        
+        expires_at = int(exp) if exp is not None else int(now + expire_in)
+        signed = sign_auth_parts(parts, self.key, expires_at, self.auth_type, self.ttl, self.rand, self.uid)
+        
+        reuse_until = expires_at if exp is not None else now + expire_in * self.reuse_ratio
+        self._cache[cache_key] = (signed, reuse_until)
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return signed
 
 # --- 核心数据结构 ---
 
@@ -118,6 +226,81 @@ def parse_m3u8_string(input_string, base_url=None):
             
     return streams
 
+class MediaPlaylist:
+    """媒体播放列表 (分片列表) 的解析结果"""
+    def __init__(self):
+        self.media_sequence = 0
+        self.target_duration = None
+        self.endlist = False
+        self.segments = []  # [(序号, 时长, URL, PROGRAM-DATE-TIME 时间戳或 None)]
+
+MEDIA_SEQUENCE_PATTERN = re.compile(r'^#EXT-X-MEDIA-SEQUENCE:(\d+)')
+TARGET_DURATION_PATTERN = re.compile(r'^#EXT-X-TARGETDURATION:([\d.]+)')
+EXTINF_PATTERN = re.compile(r'^#EXTINF:([\d.]+)')
+PROGRAM_DATE_TIME_PATTERN = re.compile(r'^#EXT-X-PROGRAM-DATE-TIME:(.+)')
+
+def parse_program_date_time(value):
+    """解析 EXT-X-PROGRAM-DATE-TIME 的 ISO 8601 时间，返回 UNIX 时间戳，失败返回 None"""
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+def parse_media_playlist(input_string, base_url=None):
+    """
+    解析媒体播放列表，提取分片序号、时长、URL 和 PROGRAM-DATE-TIME。
+    没有显式 PROGRAM-DATE-TIME 的分片按前一个分片的时间加时长推算。
+    """
+    playlist = MediaPlaylist()
+    sequence = None
+    duration = None
+    pending_pdt = None
+    next_pdt = None
+    
+    for line in input_string.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        
+        if line.startswith('#'):
+            if line.startswith('#EXTINF:'):
+                m = EXTINF_PATTERN.match(line)
+                duration = float(m.group(1)) if m else 0.0
+            elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+                pending_pdt = parse_program_date_time(PROGRAM_DATE_TIME_PATTERN.match(line).group(1))
+            elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                m = MEDIA_SEQUENCE_PATTERN.match(line)
+                if m:
+                    playlist.media_sequence = int(m.group(1))
+            elif line.startswith('#EXT-X-TARGETDURATION:'):
+                m = TARGET_DURATION_PATTERN.match(line)
+                if m:
+                    playlist.target_duration = float(m.group(1))
+            elif line.startswith('#EXT-X-ENDLIST'):
+                playlist.endlist = True
+            continue
+        
+        if duration is None:
+            continue
+        if sequence is None:
+            sequence = playlist.media_sequence
+        
+        url = line
+        if base_url and not url.startswith('http'):
+            url = urllib.parse.urljoin(base_url, url)
+        
+        pdt = pending_pdt if pending_pdt is not None else next_pdt
+        playlist.segments.append((sequence, duration, url, pdt))
+        next_pdt = pdt + duration if pdt is not None else None
+        sequence += 1
+        duration = None
+        pending_pdt = None
+    
+    return playlist
+
 # --- FFmpeg 检查函数 ---
 
 def check_ffmpeg():
@@ -130,6 +313,18 @@ def check_ffmpeg():
         print("请访问 https://ffmpeg.org/ 下载并安装 FFmpeg。")
         return False
 
+async def async_run_ffmpeg(command, cwd=None):
+    """
+    以子进程方式异步运行 FFmpeg (不阻塞事件循环)，返回码非 0 时抛出 subprocess.CalledProcessError。
+    cwd 为子进程的工作目录，不修改当前进程的工作目录 (多个下载任务可同时运行)。
+    """
+    process = await asyncio.create_subprocess_exec(*command, cwd=cwd, stdout=asyncio.subprocess.DEVNULL,
+                                                   stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+    return stderr
+
 # --- 辅助函数：简易进度条 ---
 def display_progress_bar(prefix, current, total, bar_length=15):
     """显示简易文本进度条"""
@@ -144,378 +339,2469 @@ def display_progress_bar(prefix, current, total, bar_length=15):
     # 进度条末尾加上百分比
     return f'{prefix} [{arrow + spaces}] {current}/{total} ({percent * 100:.1f}%)'
 
-# --- 异步下载段函数（增加存在性检查和重试） ---
-async def async_download_segment(session, ts_url, ts_local_path, cookie, max_retries=3):
+# --- 共享分片存储 (内容寻址，打包文件 + 索引) ---
+
+# 分片 URL 中每次请求都会变化的查询参数 (例如 ?m=1700000000)，不参与分片键
+VOLATILE_QUERY_PARAMS = ('m',)
+
+def normalize_segment_key(url, volatile_params=VOLATILE_QUERY_PARAMS):
+    """去掉 URL 中的易变查询参数并排序其余参数，得到稳定的分片键"""
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+             if k not in volatile_params]
+    query.sort()
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, urllib.parse.urlencode(query), ''))
+
+class SegmentStoreBusyError(RuntimeError):
+    """共享分片存储目录已被其他进程占用"""
+
+class SegmentStore:
+    """
+    可在多个下载任务和多次重跑之间共享的磁盘分片存储。
+
+    索引分两级: 规范化 URL -> 内容哈希 (SHA-256) -> (打包文件, 偏移, 长度)。
+    分片顺序追加到若干个打包文件 (pack_XXXXXX.dat) 中，而不是每个分片一个文件，
+    避免分片数量巨大时的 inode 开销。总大小超过 max_bytes 时，按打包文件粒度
+    淘汰最久未使用的数据。
+
+    同一进程内的并发任务 (例如开播监控启动的多个录制) 共享一个实例即可，同一分片只会被下载一次。
+    打开时会对目录加文件锁，同一目录同一时间只能由一个进程使用，
+    其他进程打开时抛出 SegmentStoreBusyError。
+    读取时校验内容哈希，损坏或不一致的数据视为未命中。
+
+    索引持久化为快照 (index.json) 加追加写的日志 (index-<编号>.log)：每次写入/淘汰只追加一行日志，
+    日志行数超过索引条目数时在锁外写一次新快照，总开销与分片数量成线性关系。
+    打开时重放日志，并删除索引中没有记录的打包文件 (例如进程在写日志前中断)，保证容量上限在异常退出后仍然有效。
+    """
+    INDEX_NAME = "index.json"
+    LOG_PATTERN = re.compile(r'^index-(\d+)\.log$')
+    PACK_PATTERN = re.compile(r'^pack_(\d+)\.dat$')
+    LOCK_NAME = "store.lock"
+    COMPACT_MIN_ENTRIES = 4096  # 日志至少积累这么多行才会写新快照
+
+    def __init__(self, root, max_bytes=10 * 1024 ** 3, pack_size=64 * 1024 ** 2,
+                 volatile_params=VOLATILE_QUERY_PARAMS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pack_size = pack_size
+        self.volatile_params = tuple(volatile_params)
+
+        self._lock = threading.Lock()
+        self._inflight = {}   # 分片键 -> threading.Event (正在下载中)
+        self._keys = {}       # 分片键 -> 内容哈希
+        self._blobs = {}      # 内容哈希 -> [pack_id, offset, length]
+        self._packs = {}      # pack_id -> {"size": 字节数, "last_used": 时间戳}
+        self._current_pack = None
+        self._writer = None
+        self._log = None
+        self._log_entries = 0
+        self._generation = 0
+        self._compact_lock = threading.Lock()  # 保证快照按日志编号顺序写入
+        self._lock_file = None
+
+        os.makedirs(root, exist_ok=True)
+        self._acquire_dir_lock()
+        try:
+            self._load_index()
+            self._compact()
+        except BaseException:
+            self._release_dir_lock()
+            raise
+
+    def _acquire_dir_lock(self):
+        """对存储目录加进程间独占锁 (非阻塞)，失败时抛出 SegmentStoreBusyError"""
+        lock_file = open(os.path.join(self.root, self.LOCK_NAME), 'a+b')
+        try:
+            if sys.platform.startswith('win'):
+                import msvcrt
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise SegmentStoreBusyError(f"共享分片存储 {self.root} 正被其他进程使用")
+        self._lock_file = lock_file
+
+    def _release_dir_lock(self):
+        if self._lock_file is None:
+            return
+        try:
+            if sys.platform.startswith('win'):
+                import msvcrt
+                self._lock_file.seek(0)
+                msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass
+        # POSIX 上关闭文件即释放 flock
+        self._lock_file.close()
+        self._lock_file = None
+
+    # -- 路径与索引 --
+
+    def _pack_path(self, pack_id):
+        return os.path.join(self.root, f"pack_{pack_id:06d}.dat")
+
+    def _log_path(self, generation):
+        return os.path.join(self.root, f"index-{generation}.log")
+
+    def _log_generations(self):
+        return sorted(int(match.group(1)) for match in map(self.LOG_PATTERN.match, os.listdir(self.root)) if match)
+
+    def _load_index(self):
+        """读取快照并重放之后的日志，再与磁盘上的打包文件核对"""
+        index_path = os.path.join(self.root, self.INDEX_NAME)
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+
+        snapshot_generation = data.get("generation", 0)
+        self._packs = {int(pack_id): dict(info) for pack_id, info in data.get("packs", {}).items()}
+        self._blobs = {digest: list(blob) for digest, blob in data.get("blobs", {}).items()}
+        self._keys = dict(data.get("keys", {}))
+
+        generations = self._log_generations()
+        for generation in generations:
+            if generation >= snapshot_generation:
+                self._replay_log(generation)
+        self._generation = max([snapshot_generation] + generations)
+
+        # 打包文件丢失或被截断时，丢弃对应的记录；大小按磁盘上的实际大小计入容量
+        for pack_id in list(self._packs):
+            try:
+                self._packs[pack_id]["size"] = os.path.getsize(self._pack_path(pack_id))
+            except OSError:
+                del self._packs[pack_id]
+        self._blobs = {digest: blob for digest, blob in self._blobs.items()
+                       if blob[0] in self._packs and blob[1] + blob[2] <= self._packs[blob[0]]["size"]}
+        self._keys = {k: d for k, d in self._keys.items() if d in self._blobs}
+
+        # 已持有目录锁，索引中没有记录的打包文件不会再被任何进程引用，直接删除
+        for name in os.listdir(self.root):
+            match = self.PACK_PATTERN.match(name)
+            if match and int(match.group(1)) not in self._packs:
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+        self._evict_locked()
+
+    def _replay_log(self, generation):
+        try:
+            log_file = open(self._log_path(generation), 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # 异常退出时只写了一半的最后一行
+                if "e" in record:
+                    self._drop_pack_locked(record["e"])
+                    continue
+                blob = record.get("b")
+                if blob is not None:
+                    pack = self._packs.setdefault(blob[0], {"size": 0, "last_used": record["t"]})
+                    pack["size"] = max(pack["size"], blob[1] + blob[2])
+                    pack["last_used"] = record["t"]
+                    self._blobs[record["d"]] = blob
+                if record["d"] in self._blobs:
+                    self._keys[record["k"]] = record["d"]
+
+    def _log_locked(self, record):
+        """追加一行索引日志 (打包文件中的数据先写出，日志只引用已落盘的内容)"""
+        if self._writer is not None:
+            self._writer.flush()
+        self._log.write(json.dumps(record, separators=(',', ':')) + "\n")
+        self._log.flush()
+        self._log_entries += 1
+
+    def _rotate_log_locked(self):
+        """切换到新的日志文件，返回包含此前所有记录的快照数据"""
+        if self._writer is not None:
+            self._writer.flush()
+        if self._log is not None:
+            self._log.close()
+        self._generation += 1
+        self._log = open(self._log_path(self._generation), 'a', encoding='utf-8')
+        self._log_entries = 0
+        return {
+            "generation": self._generation,
+            "packs": {str(pack_id): dict(info) for pack_id, info in self._packs.items()},
+            "blobs": dict(self._blobs),
+            "keys": dict(self._keys),
+        }
+
+    def _write_snapshot(self, snapshot):
+        """在锁外序列化快照，原子替换后删除已被快照包含的旧日志"""
+        index_path = os.path.join(self.root, self.INDEX_NAME)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+        for generation in self._log_generations():
+            if generation < snapshot["generation"]:
+                try:
+                    os.remove(self._log_path(generation))
+                except OSError:
+                    pass
+
+    def _compact(self, blocking=True):
+        """写一次新快照；blocking 为 False 时如果已有线程在写快照则直接返回"""
+        if not self._compact_lock.acquire(blocking):
+            return
+        try:
+            with self._lock:
+                if self._lock_file is None:
+                    return
+                snapshot = self._rotate_log_locked()
+            self._write_snapshot(snapshot)
+        finally:
+            self._compact_lock.release()
+
+    def flush(self):
+        """将索引快照写回磁盘 (日志已在每次写入时落盘，通常不需要手动调用)"""
+        self._compact()
+
+    def close(self):
+        with self._compact_lock:
+            with self._lock:
+                if self._lock_file is None:
+                    return
+                snapshot = self._rotate_log_locked()
+                self._log.close()
+                self._log = None
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                    self._current_pack = None
+            self._write_snapshot(snapshot)
+            with self._lock:
+                self._release_dir_lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # -- 读写 --
+
+    def key_for(self, url):
+        return normalize_segment_key(url, self.volatile_params)
+
+    def total_size(self):
+        return sum(pack["size"] for pack in self._packs.values())
+
+    def __contains__(self, url):
+        return self.key_for(url) in self._keys
+
+    def get(self, url):
+        """按 URL 读取分片内容，未命中时返回 None"""
+        key = self.key_for(url)
+        with self._lock:
+            digest = self._keys.get(key)
+            if digest is None:
+                return None
+            pack_id, offset, length = self._blobs[digest]
+            self._packs[pack_id]["last_used"] = time.time()
+            if pack_id == self._current_pack:
+                self._writer.flush()
+        try:
+            with open(self._pack_path(pack_id), 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except OSError:
+            data = None
+        
+        if data is None or len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+            # 打包文件损坏或被外部修改: 丢弃该记录，下次重新下载
+            with self._lock:
+                if self._blobs.get(digest) == [pack_id, offset, length]:
+                    del self._blobs[digest]
+                    self._keys = {k: d for k, d in self._keys.items() if d != digest}
+            return None
+        return data
+
+    def put(self, url, data):
+        """写入分片内容，内容相同的分片只保存一份。返回内容哈希。"""
+        key = self.key_for(url)
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            record = {"k": key, "d": digest, "t": time.time()}
+            if digest not in self._blobs:
+                record["b"] = self._append_locked(digest, data)
+            self._keys[key] = digest
+            self._log_locked(record)
+            compact = self._log_entries >= max(self.COMPACT_MIN_ENTRIES, len(self._keys))
+        if compact:
+            self._compact(blocking=False)
+        return digest
+
+    def _append_locked(self, digest, data):
+        if self._writer is None or self._packs[self._current_pack]["size"] >= self.pack_size:
+            if self._writer is not None:
+                self._writer.close()
+            # 上次运行可能在写入索引前中断，留下索引中没有记录的打包文件；跳过磁盘上已存在的编号
+            pack_id = max(self._packs, default=-1) + 1
+            while os.path.exists(self._pack_path(pack_id)):
+                pack_id += 1
+            self._current_pack = pack_id
+            self._packs[pack_id] = {"size": 0, "last_used": time.time()}
+            self._writer = open(self._pack_path(pack_id), 'wb')
+
+        pack = self._packs[self._current_pack]
+        offset = self._writer.tell()
+        self._writer.write(data)
+        pack["size"] = offset + len(data)
+        pack["last_used"] = time.time()
+        blob = [self._current_pack, offset, len(data)]
+        self._blobs[digest] = blob
+        self._evict_locked()
+        return blob
+
+    def _evict_locked(self):
+        """总大小超过上限时，按 LRU 顺序整体删除打包文件 (当前写入中的除外)"""
+        total = self.total_size()
+        while total > self.max_bytes:
+            candidates = [pack_id for pack_id in self._packs if pack_id != self._current_pack]
+            if not candidates:
+                break
+            victim = min(candidates, key=lambda pack_id: self._packs[pack_id]["last_used"])
+            total -= self._packs[victim]["size"]
+            self._drop_pack_locked(victim)
+            if self._log is not None:
+                self._log_locked({"e": victim})
+            try:
+                os.remove(self._pack_path(victim))
+            except OSError:
+                pass
+
+    def _drop_pack_locked(self, pack_id):
+        """从索引中移除一个打包文件及其中的全部分片"""
+        self._packs.pop(pack_id, None)
+        dropped = {d for d, blob in self._blobs.items() if blob[0] == pack_id}
+        for digest in dropped:
+            del self._blobs[digest]
+        if dropped:
+            self._keys = {k: d for k, d in self._keys.items() if d not in dropped}
+
+    def fetch(self, url, fetcher):
+        """
+        读取分片，未命中时调用 fetcher() 下载并写入存储。
+        多个线程同时请求同一分片时只会下载一次，其余线程等待结果。
+        返回: (分片内容, 是否命中存储)
+        """
+        key = self.key_for(url)
+        while True:
+            data = self.get(url)
+            if data is not None:
+                return data, True
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    if key in self._keys:
+                        # get() 之后其他线程刚好写入了该分片，重新读取
+                        continue
+                    event = threading.Event()
+                    self._inflight[key] = event
+                    break
+            # 其他任务正在下载同一分片，等待其完成后重新读取；若对方失败则由本线程重试
+            event.wait()
+
+        try:
+            data = fetcher()
+            self.put(url, data)
+            return data, False
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+# --- 异步下载段函数（增加存在性检查和重试） ---
+async def async_download_segment(session, ts_url, ts_local_path, cookie, max_retries=3, segment_store=None, executor=None):
+    """
+    异步下载单个分片，失败重试 max_retries 次，并在下载前检查本地是否存在。
+    如果提供 segment_store，则分片写入共享存储而不是 ts_local_path，命中存储时视为跳过。
+    返回: (成功状态, 文件路径, 是否跳过)
+    """
+    
+    # * 断点续传/存在性检查 *
+    if segment_store is None and os.path.exists(ts_local_path) and os.path.getsize(ts_local_path) > 0:
+        return True, ts_local_path, True # 成功，已跳过
+    
+    # 使用 urllib.request 进行同步下载的包装器 (在线程池中运行)
+    def fetch_bytes():
+        req = urllib.request.Request(ts_url)
+        if cookie:
+            req.add_header('Cookie', cookie)
+        
+        with urllib.request.urlopen(req, timeout=10) as response: 
+            return response.read()
+    
+    def sync_fetch():
+        data = fetch_bytes()
+        # 写入文件
+        with open(ts_local_path, 'wb') as out_file:
+            out_file.write(data)
+    
+    # 如果文件不存在，则开始下载
+    for attempt in range(max_retries):
+        try:
+            # 阻塞调用，但放入线程池中运行，不阻塞事件循环
+            if segment_store is not None:
+                _, hit = await asyncio.get_event_loop().run_in_executor(executor, segment_store.fetch, ts_url, fetch_bytes)
+                return True, ts_local_path, hit
+            await asyncio.get_event_loop().run_in_executor(executor, sync_fetch) 
+            return True, ts_local_path, False # 成功，未跳过
+        
+        except Exception as e:
+            if attempt < max_retries - 1:
+                # print(f"\n[警告] 分片 {os.path.basename(ts_local_path)} 下载失败 (第 {attempt + 1} 次)，正在重试...")
+                await asyncio.sleep(5) # 重试前等待 5 秒
+            else:
+                # print(f"\n[严重警告] 分片 {os.path.basename(ts_local_path)} 最终下载失败，跳过。错误: {e}")
+                return False, ts_local_path, False # 最终失败，未跳过
+
+    return False, ts_local_path, False
+
+def sanitize_filename(name):
+    """清理文件名中的非法字符（跨平台处理）"""
+    # Windows非法字符: < > : " / \ | ? *
+    # Linux非法字符: / 和 null
+    # 使用平台无关的清理方式
+    name = re.sub(r'[<>:"/|?*\\]', '_', name)
+    # 移除控制字符和null字符
+    return re.sub(r'[\x00-\x1f\x7f]', '_', name)
+
+def default_download_filename(stream, suggested_filename=None):
+    """根据节目名称或流信息生成默认的下载文件名"""
+    if suggested_filename:
+        return f"{sanitize_filename(suggested_filename)}_{stream.resolution}.ts"
+    return f"HLS_Stream_FULL_{stream.resolution}_{stream.bandwidth.replace(' ', '_').replace('.', 'p')}.ts"
+
+# --- 边下载边封装 fragmented MP4 ---
+
+def read_file_bytes(path):
+    """读取整个文件的内容"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+class FragmentedMp4Writer:
+    """
+    将 TS 分片按顺序实时送入一个 FFmpeg 进程，边下载边封装为 fragmented MP4。
+
+    FFmpeg 使用 empty_moov + frag_keyframe，moov 位于文件开头 (适合直接发布/边下边播)，
+    最后一个分片写入并关闭输入后文件即完整，不需要再做一次完整的 TS -> MP4 转封装。
+
+    add()/skip() 接受乱序到达的分片 (按索引排队，缺失的分片用 skip 标记)，
+    append() 用于已经有序的分片 (例如 iter_segments 的输出)。
+    """
+    def __init__(self, output_path, first_index=0, log_path=None):
+        self.output_path = output_path
+        self.next_index = first_index
+        self.log_path = log_path
+        self.written_segments = 0
+        self.error = None
+        
+        self._waiting = {}  # 索引 -> 读取分片内容的函数 (None 表示跳过)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)  # 单线程保证写入顺序
+        self._process = None
+        self._log_file = None
+        self._closed = False
+
+    def start(self):
+        command = [
+            "ffmpeg", "-y",
+            "-loglevel", "error",
+            "-f", "mpegts",
+            "-i", "pipe:0",
+            "-c", "copy",
+            "-f", "mp4",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            self.output_path,
+        ]
+        self._log_file = open(self.log_path, 'wb') if self.log_path else None
+        # FFmpeg 放在独立的进程组中，Ctrl+C 不会直接打断它，由 close() 关闭输入后正常写完文件
+        if sys.platform.startswith('win'):
+            group_options = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            group_options = {"start_new_session": True}
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                         stderr=self._log_file or subprocess.DEVNULL, **group_options)
+
+    def _write(self, data):
+        if self.error is not None or not data:
+            return
+        if self._process.poll() is not None:
+            # 写入的数据可能只进入了管道缓冲区，不一定会触发管道断开错误
+            self.error = f"FFmpeg 已退出 (退出码 {self._process.returncode})"
+            return
+        try:
+            self._process.stdin.write(data)
+            self.written_segments += 1
+        except (OSError, ValueError) as e:
+            # FFmpeg 已退出 (管道断开)，后续分片不再写入，结束时报告错误
+            self.error = e
+
+    async def append(self, data):
+        """按顺序写入一个分片"""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, data)
+
+    async def add(self, index, loader):
+        """登记索引为 index 的分片，loader() 返回分片内容；轮到它时才读取并写入"""
+        self._waiting[index] = loader
+        await self._drain()
+
+    async def skip(self, index):
+        """标记索引为 index 的分片下载失败，不阻塞后续分片"""
+        self._waiting[index] = None
+        await self._drain()
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while self.next_index in self._waiting:
+            loader = self._waiting.pop(self.next_index)
+            self.next_index += 1
+            if loader is not None:
+                await loop.run_in_executor(self._executor, lambda: self._write(loader()))
+
+    async def close(self):
+        """写完排队中的分片，关闭 FFmpeg 输入并等待其完成。成功返回 True；重复调用直接返回结果。"""
+        if self._closed:
+            return self.error is None
+        self._closed = True
+        loop = asyncio.get_running_loop()
+        # 前面有缺失的分片时，剩余分片按索引顺序写入
+        for index in sorted(self._waiting):
+            loader = self._waiting.pop(index)
+            if loader is not None:
+                await loop.run_in_executor(self._executor, lambda: self._write(loader()))
+        
+        def finish():
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+            return self._process.wait()
+        
+        returncode = await loop.run_in_executor(self._executor, finish)
+        self._executor.shutdown()
+        if self._log_file is not None:
+            self._log_file.close()
+        if returncode != 0 and self.error is None:
+            self.error = f"FFmpeg 退出码 {returncode}"
+        return self.error is None
+
+    def read_log(self):
+        """读取 FFmpeg 的错误输出"""
+        if not self.log_path or not os.path.exists(self.log_path):
+            return ""
+        with open(self.log_path, 'rb') as f:
+            return f.read().decode(errors='replace')
+
+async def async_perform_download(stream, cookie=None, suggested_filename=None, segment_store=None, output_filename=None,
+                                 build_index=False, output_format=None, dvr=None, executor=None):
+    """
+    三阶段下载与合并 (异步并发下载历史分片，FFmpeg 下载实时分片)
+    
+    如果提供 segment_store (SegmentStore)，历史分片从共享存储读取/写入，
+    并直接按顺序拼接成历史文件，不再为每个分片单独落盘。
+    未提供 output_filename 时使用 default_download_filename 生成的默认文件名 (本函数不会询问用户)。
+    build_index 为 True 时在最终文件旁生成剪辑索引 (<文件名>.idx.json)：历史分片按字节拼接，
+    实时分片用 iter_segments 下载后追加到同一文件，索引在写入过程中同步构建，
+    每个分片的墙上时间取自播放列表的 PROGRAM-DATE-TIME。
+    output_format 为 "mp4" (或输出文件名以 .mp4 结尾) 时，分片按顺序实时封装为 fragmented MP4，
+    最后一个分片写入后即完成，不再生成中间 TS 文件和做最终合并。
+    提供 dvr (DvrRingBuffer) 时，实时分片从一开始就与历史分片同时用 iter_segments 下载，立即写入回看缓冲区
+    (历史分片不进入缓冲区)；需要接在历史部分之后写入的实时分片 (MP4、剪辑索引) 先暂存到临时文件，
+    历史部分完成后补写。此时不打印逐分片的进度，避免干扰回看命令的输入。
+    executor 为播放列表和历史分片请求使用的线程池 (默认使用事件循环的默认线程池)；
+    同一事件循环中运行多个下载时应为每个下载单独提供，避免互相占满线程。实时阶段的 iter_segments 总是使用自己的线程池。
+    """
+    if not check_ffmpeg(): return
+    
+    # --- 0. 初始化和路径设置 ---
+    final_output_filename = output_filename or default_download_filename(stream, suggested_filename)
+    if output_format is None:
+        output_format = "mp4" if final_output_filename.lower().endswith(".mp4") else "ts"
+    if output_format == "mp4" and not final_output_filename.lower().endswith(".mp4"):
+        final_output_filename = os.path.splitext(final_output_filename)[0] + ".mp4"
+    
+    # 确保使用绝对路径，避免路径问题
+    if not os.path.isabs(final_output_filename):
+        final_output_filename = os.path.join(os.getcwd(), final_output_filename)
+    
+    # 同一目录下可能有多个任务同时开始 (例如开播监控)，用目标文件名的哈希区分临时目录
+    output_tag = md5sum(final_output_filename.encode('utf-8'))[:8]
+    temp_dir = os.path.join(os.path.dirname(final_output_filename), f"temp_hls_download_{int(time.time())}_{output_tag}")
+    base_name = os.path.splitext(os.path.basename(final_output_filename))[0]
+    history_output_file = os.path.join(temp_dir, f"{base_name}_0.ts")
+    live_output_file = os.path.join(temp_dir, f"{base_name}_1.ts")
+    
+    print(f"\n[开始] 正在开始三阶段下载，最终文件：{final_output_filename}")
+    print(f"[信息] 所有临时文件将存储在: {temp_dir}")
+    
+    download_success = True
+    show_progress = dvr is None
+    index_builder = TsIndexBuilder() if build_index and output_format != "mp4" else None
+    ts_index = None
+    mp4_writer = None
+    live_task = None
+    live_file = None
+    spool_file = None
+    
+    try:
+        os.makedirs(temp_dir, exist_ok=True)
+    except Exception as e:
+        print(f"[错误] 无法创建临时目录 {temp_dir}: {e}")
+        return
+
+    try:
+        # --- 1. 阶段 1/3: 准备工作 (M3U8 解析) ---
+        print("\n--- 阶段 1/3: 准备工作 (解析流信息) ---")
+        
+        # ---------------------------------------------------------------------
+        # M3U8 解析 (请求放入线程池，不阻塞事件循环中的其他任务)
+        # ---------------------------------------------------------------------
+        top_level_url = stream.url 
+        final_stream_url = top_level_url
+        loop = asyncio.get_running_loop()
+        
+        try:
+            top_m3u8_content = (await loop.run_in_executor(executor, http_get, top_level_url, cookie)).decode('utf-8')
+            
+            sub_streams = parse_m3u8_string(top_m3u8_content, base_url=top_level_url)
+            user_bandwidth_raw = int(float(stream.bandwidth.split()[0]) * 1000000) 
+            selected_sub_stream_url = None
+            
+            for s in sub_streams:
+                s_bandwidth_raw = 0
+                try:
+                    s_bandwidth_raw = int(float(s.bandwidth.split()[0]) * 1000000)
+                except:
+                    pass
+                
+                resolution_match = (s.resolution == stream.resolution)
+                bandwidth_match = abs(s_bandwidth_raw - user_bandwidth_raw) < 10000 
+                
+                if resolution_match and bandwidth_match:
+                    selected_sub_stream_url = s.url
+                    break
+            
+            if selected_sub_stream_url:
+                final_stream_url = selected_sub_stream_url
+                print(f"[信息] 成功找到子流 URL: {final_stream_url}")
+            else:
+                print(f"[警告] 未能找到匹配的子流 URL。假定用户选择的 URL 本身 ({top_level_url[:50]}...) 即为子流播放列表。")
+                final_stream_url = top_level_url
+
+            live_m3u8_content = (await loop.run_in_executor(executor, http_get, final_stream_url, cookie)).decode('utf-8')
+                
+            ts_url_pattern = re.compile(r'index_(\d)_(\d+)\.ts(\?m=\d+)')
+            last_index = -1
+            last_segment_url = None
+            
+            for line in live_m3u8_content.splitlines():
+                line = line.strip()
+                ts_match = ts_url_pattern.search(line)
+                if ts_match:
+                    current_index = int(ts_match.group(2))
+                    if current_index > last_index:
+                        last_index = current_index
+                        last_segment_url = line 
+            
+            if last_index == -1:
+                print("[错误] 未能在子流 M3U8 中找到可识别的分片 URL 模式。下载中止。")
+                return
+                
+            print(f"[信息] 检测到最新的分片索引 N 为: {last_index}。")
+                
+            base_prefix_match = re.search(r'(.*/index_\d+)\.m3u8', final_stream_url)
+            
+            if not base_prefix_match:
+                final_stream_dir = final_stream_url.rsplit('/', 1)[0]
+                index_match = re.search(r'(index_\d+)', last_segment_url)
+                if index_match:
+                     base_prefix = f"{final_stream_dir}/{index_match.group(1)}"
+                else:
+                    print("[严重错误] 无法从 URL 构造分片基础前缀。下载中止。")
+                    return
+            else:
+                 base_prefix = base_prefix_match.group(1) 
+            
+            url_suffix_match = re.search(r'(\.ts\?m=\d+)', last_segment_url)
+            url_suffix = url_suffix_match.group(1) if url_suffix_match else ".ts"
+            
+        except Exception as e:
+            print(f"[错误] 阶段 1 发生致命错误: {e}")
+            return
+        
+        # --- 2. 阶段 A: 异步并发下载历史分片 (0 到 N) ---
+        
+        print(f"\n--- 阶段 2/3: 异步并发下载历史分片 (索引 0 到 {last_index}) ---")
+        total_segments = last_index + 1
+        print(f"[信息] 将使用 asyncio 并发下载 {total_segments} 个历史分片 (重试 3 次，支持断点续传)。")
+        
+        # 2.1 准备下载任务列表
+        # 播放列表中仍保留的分片带有时长和 PROGRAM-DATE-TIME，构建索引时作为墙上时间 (按分片文件名中的索引对应)
+        live_playlist = parse_media_playlist(live_m3u8_content, base_url=final_stream_url)
+        segment_info = {}
+        for _, duration, url, pdt in live_playlist.segments:
+            ts_match = ts_url_pattern.search(url)
+            if ts_match:
+                segment_info[int(ts_match.group(2))] = (duration, pdt)
+        
+        tasks = []
+        ts_urls = []
+        path_to_index = {}
+        for i in range(total_segments):
+            ts_url = f"{base_prefix}_{i}{url_suffix}"
+            ts_local_path = os.path.join(temp_dir, f"segment_{i}.ts")
+            ts_urls.append(ts_url)
+            path_to_index[ts_local_path] = i
+            tasks.append(async_download_segment(None, ts_url, ts_local_path, cookie, max_retries=3,
+                                                segment_store=segment_store, executor=executor))
+        
+        if output_format == "mp4":
+            print(f"[信息] 分片将按顺序实时封装为 fragmented MP4: {final_output_filename}")
+            mp4_writer = FragmentedMp4Writer(final_output_filename, log_path=os.path.join(temp_dir, "ffmpeg_mp4.log"))
+            try:
+                mp4_writer.start()
+            except Exception as e:
+                print(f"[错误] 无法启动 FFmpeg 封装进程: {e}")
+                mp4_writer = None
+                return
+        
+        # 实时分片 (阶段 3) 的下载与写入。回看模式下与历史分片同时开始，缓冲区无需等待历史下载完成
+        live_format = "MP4" if mp4_writer is not None else "TS"
+        live_start_sequence = live_playlist.segments[-1][0] + 1 if live_playlist.segments else None
+        live_count = 0
+        # MP4 和剪辑索引需要按顺序接在历史部分之后，回看模式下历史完成前先暂存到 live_output_file
+        live_direct = dvr is None or (mp4_writer is None and index_builder is None)
+        spooled = []  # 暂存的分片: (MediaSegment 不含内容, 偏移, 长度)
+        
+        async def write_live(segment):
+            """把一个实时分片写入最终输出 (MP4 或 TS 文件)，并同步构建剪辑索引"""
+            if mp4_writer is not None:
+                await mp4_writer.append(segment.data)
+                if mp4_writer.error is not None:
+                    raise RuntimeError(f"FFmpeg 封装失败: {mp4_writer.error}")
+            else:
+                live_file.write(segment.data)
+            if index_builder is not None:
+                index_builder.begin_segment(sequence=segment.sequence, duration=segment.duration,
+                                            wall_time=segment.program_date_time)
+                index_builder.feed(segment.data)
+        
+        async def ingest_live():
+            nonlocal live_count
+            try:
+                async for segment in iter_segments(final_stream_url, cookie=cookie, start_sequence=live_start_sequence,
+                                                   segment_store=segment_store):
+                    if dvr is not None:
+                        dvr.add(segment)
+                    if live_direct:
+                        await write_live(segment)
+                    else:
+                        offset = spool_file.tell()
+                        spool_file.write(segment.data)
+                        spooled.append((MediaSegment(segment.sequence, segment.duration, segment.url,
+                                                     segment.program_date_time, None, segment.fetched_at),
+                                        offset, len(segment.data)))
+                    live_count += 1
+                    if show_progress:
+                        print(f"\r实时分片 [{live_format}]: 已写入 {live_count} 个 (序号 {segment.sequence})", end='', flush=True)
+                print("\n--- 直播已结束 ---")
+            except asyncio.CancelledError:
+                print(f"\n[中断] 停止实时下载，正在完成 {live_format} 文件...")
+            except Exception as e:
+                print(f"\n[错误] 实时下载过程中发生错误: {e}")
+        
+        async def stop_live():
+            if live_task is not None and not live_task.done():
+                live_task.cancel()
+                try:
+                    await live_task
+                except asyncio.CancelledError:
+                    pass
+        
+        if dvr is not None:
+            print(f"[信息] 实时分片 (从序号 {live_start_sequence} 开始) 与历史分片同时下载，立即写入回看缓冲区。")
+            if live_direct:
+                live_file = open(live_output_file, 'wb')
+            else:
+                spool_file = open(live_output_file, 'w+b')
+            live_task = asyncio.ensure_future(ingest_live())
+        
+        # 2.2 运行异步下载任务并监控进度
+        results = []
+        completed_count = 0
+        downloaded_count = 0
+        skipped_count = 0
+        
+        start_time = time.time()
+        tasks = [asyncio.ensure_future(task) for task in tasks]
+        
+        try:
+            for f in asyncio.as_completed(tasks):
+                # 接收结果: success, path, skipped
+                success, path, skipped = await f
+            
+                results.append((success, path))
+                completed_count += 1
+            
+                if mp4_writer is not None:
+                    # 分片乱序完成，由 mp4_writer 按索引排队后顺序写入
+                    index = path_to_index[path]
+                    if not success:
+                        await mp4_writer.skip(index)
+                    elif segment_store is not None:
+                        await mp4_writer.add(index, lambda url=ts_urls[index]: segment_store.get(url))
+                    else:
+                        await mp4_writer.add(index, lambda path=path: read_file_bytes(path))
+                    if mp4_writer.error is not None:
+                        # FFmpeg 已退出，继续下载也无法写入
+                        print(f"\n[严重错误] FFmpeg 封装进程已退出，停止下载: {mp4_writer.error}")
+                        download_success = False
+                        await stop_live()
+                        live_task = None
+                        break
+            
+                if success:
+                    if skipped:
+                        skipped_count += 1
+                    else:
+                        downloaded_count += 1
+            
+                # 实时打印进度
+                time_elapsed = time.time() - start_time
+                download_speed = (downloaded_count / time_elapsed) if time_elapsed > 0 and downloaded_count > 0 else 0
+            
+                # 历史分片进度条
+                history_progress_text = display_progress_bar(
+                    f"历史分片 (D: {downloaded_count}, S: {skipped_count}, {download_speed:.1f} seg/s)", 
+                    completed_count, 
+                    total_segments, 
+                    bar_length=15
+                )
+            
+                # FFmpeg 状态 (简化)
+                ffmpeg_status_text = "实时下载 [FFmpeg]: 正在准备..."
+            
+                # 清除当前行并重新打印统一进度条
+                if show_progress:
+                    print(f"\r{history_progress_text} | {ffmpeg_status_text}", end='', flush=True)
+        except BaseException:
+            # 被取消 (Ctrl+C) 或出错时也要关闭 FFmpeg 封装进程，已写入的分片仍是完整可播放的 MP4
+            if mp4_writer is not None:
+                print("\n[中断] 历史分片下载已中止，正在完成 MP4 文件...")
+                if await mp4_writer.close():
+                    print(f"[成功] 已写入的 {mp4_writer.written_segments} 个分片已保存到: {final_output_filename}")
+                else:
+                    print(f"[严重错误] FFmpeg 封装 MP4 失败: {mp4_writer.error}")
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # 下载完成后，打印最终进度
+        history_progress_text = display_progress_bar(
+            f"历史分片 (完成 D:{downloaded_count}, S:{skipped_count})", 
+            completed_count, 
+            total_segments, 
+            bar_length=15
+        )
+        print(f"\r{history_progress_text}", end='\n', flush=True)
+        
+        # 2.3 历史分片合并
+        history_segments_count = sum(1 for success, path in results if success)
+        
+        if history_segments_count == 0:
+            print("[警告] 没有成功下载任何历史分片，跳过历史合并。")
+            download_success = False
+        elif mp4_writer is not None:
+            # 历史分片已在下载过程中写入 MP4，无需合并
+            if download_success:
+                print(f"[成功] {history_segments_count} 个历史分片已写入 MP4。")
+        elif segment_store is not None or index_builder is not None:
+            # TS 分片可以直接按字节顺序拼接 (FFmpeg concat 会重新封装，字节偏移与索引不再对应)
+            def load_segment(i):
+                if segment_store is not None:
+                    return segment_store.get(ts_urls[i])
+                seg_path = os.path.join(temp_dir, f"segment_{i}.ts")
+                return read_file_bytes(seg_path) if os.path.exists(seg_path) else None
+            
+            def write_history_by_bytes():
+                missing = 0
+                with open(history_output_file, 'wb') as out_file:
+                    for i in range(total_segments):
+                        data = load_segment(i)
+                        if data is None:
+                            missing += 1
+                            continue
+                        out_file.write(data)
+                        if index_builder is not None:
+                            duration, wall_time = segment_info.get(i, (None, None))
+                            index_builder.begin_segment(sequence=i, duration=duration, wall_time=wall_time)
+                            index_builder.feed(data)
+                return missing
+            
+            try:
+                missing = await asyncio.get_event_loop().run_in_executor(executor, write_history_by_bytes)
+                evicted = missing - (total_segments - history_segments_count)
+                if evicted > 0:
+                    print(f"[警告] 有 {evicted} 个分片在合并前已被共享存储淘汰，请调大存储容量上限。")
+                print(f"[成功] 历史分片合并为 {os.path.basename(history_output_file)} 完成。")
+            except Exception as e:
+                print(f"[严重错误] 历史分片合并时发生未知错误: {e}")
+                download_success = False
+        else:
+            file_list_path = os.path.join(temp_dir, "history_filelist.txt")
+            
+            with open(file_list_path, 'w', encoding='utf-8') as filelist_f:
+                # 必须按索引顺序合并
+                for i in range(total_segments):
+                    seg_name = f"segment_{i}.ts"
+                    seg_path = os.path.join(temp_dir, seg_name)
+                    if os.path.exists(seg_path):
+                        # 在FFmpeg的concat文件中使用正斜杠（跨平台兼容）
+                        # 或者直接使用文件名（因为FFmpeg会在同一目录下查找）
+                        filelist_f.write(f"file '{seg_name}'\n")
+            
+            try:
+                # 使用 FFmpeg concat 协议合并历史分片
+                history_merge_command = [
+                    "ffmpeg", 
+                    "-f", "concat", 
+                    "-safe", "0", 
+                    "-i", file_list_path, 
+                    "-c", "copy",
+                    history_output_file
+                ]
+                
+                await async_run_ffmpeg(history_merge_command, cwd=temp_dir)
+                
+                print(f"[成功] 历史分片合并为 {os.path.basename(history_output_file)} 完成。")
+            except subprocess.CalledProcessError as e:
+                print(f"[严重错误] 历史分片合并失败。中止。")
+                print(e.stderr.decode())
+                download_success = False
+            except Exception as e:
+                print(f"[严重错误] 历史分片合并时发生未知错误: {e}")
+                download_success = False
+
+
+        # --- 3. 阶段 B: FFmpeg 下载后续直播分片 ($N+1$ 到 End) ---
+
+        if live_task is not None or (download_success and (mp4_writer is not None or index_builder is not None)):
+            target = "实时封装为 MP4" if mp4_writer is not None else "写入文件"
+            if dvr is not None:
+                target += "和回看缓冲区"
+            if index_builder is not None:
+                target += " (同步构建剪辑索引)"
+            print(f"\n--- 阶段 3/3: 下载后续直播分片 ({last_index + 1} 到 End) 并{target} ---")
+            print("[信息] 直播结束 (EXT-X-ENDLIST) 后自动完成 (按 Ctrl+C 提前停止)。")
+            
+            try:
+                if index_builder is not None:
+                    # 实时分片直接追加到历史文件末尾，索引偏移与最终文件保持一致
+                    live_file = open(history_output_file, 'ab')
+                elif mp4_writer is None and live_file is None:
+                    live_file = open(live_output_file, 'wb')
+                
+                if live_task is None:
+                    live_task = asyncio.ensure_future(ingest_live())
+                elif spool_file is not None:
+                    # 历史部分已完成: 补写暂存的实时分片，追上后改为直接写入
+                    drained = 0
+                    while drained < len(spooled):
+                        segment, offset, length = spooled[drained]
+                        spool_file.flush()
+                        spool_file.seek(offset)
+                        segment.data = spool_file.read(length)
+                        spool_file.seek(0, os.SEEK_END)
+                        await write_live(segment)
+                        segment.data = None
+                        drained += 1
+                    live_direct = True
+                    if drained:
+                        print(f"[信息] 已补写历史下载期间暂存的 {drained} 个实时分片。")
+                
+                await live_task
+            except asyncio.CancelledError:
+                await stop_live()
+            except Exception as e:
+                # 补写暂存分片时出错 (例如 FFmpeg 封装进程已退出)
+                print(f"\n[错误] 实时下载过程中发生错误: {e}")
+                await stop_live()
+            finally:
+                if spool_file is not None:
+                    spool_file.close()
+                    os.remove(live_output_file)
+                if live_file is not None:
+                    live_file.close()
+        elif download_success:
+            print(f"\n--- 阶段 3/3: 下载后续直播分片 ({last_index + 1} 到 End) ---")
+            print("[信息] 使用 FFmpeg 实时下载 (内置重试机制: -reconnect, 间隔 5s)。")
+            
+            download_command_1 = ["ffmpeg"]
+            
+            if cookie:
+                download_command_1.extend(["-headers", f"Cookie: {cookie}"])
+                
+            # 设置 FFmpeg 内置重试机制
+            download_command_1.extend([
+                "-live_start_index", "-1", 
+                "-reconnect", "1",
+                "-reconnect_streamed", "1", 
+                "-reconnect_delay_max", "5", 
+                "-i", final_stream_url, 
+                "-c", "copy",
+                live_output_file
+            ])
+
+            process = None
+            try:
+                print("--- FFmpeg 实时下载开始 (按 Q 键停止下载) ---")
+                process = await asyncio.create_subprocess_exec(*download_command_1, cwd=temp_dir)
+                await process.wait()
+                print("--- 实时下载命令执行完毕 ---")
+            except asyncio.CancelledError:
+                # 任务被取消 (Ctrl+C 或监控停止)：让 FFmpeg 正常结束并写完文件，再合并已下载的部分
+                print("\n[中断] 停止实时下载，正在合并已下载的部分...")
+                if process is not None and process.returncode is None:
+                    try:
+                        process.terminate()
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
+            except Exception as e:
+                print(f"[错误] 实时下载过程中发生错误: {e}")
+
+        if mp4_writer is not None:
+            if await mp4_writer.close():
+                print(f"\n[成功] 共写入 {mp4_writer.written_segments} 个分片，MP4 文件已完成: {final_output_filename}")
+            else:
+                print(f"\n[严重错误] FFmpeg 封装 MP4 失败: {mp4_writer.error}")
+                print(mp4_writer.read_log())
+        
+        if index_builder is not None:
+            ts_index = index_builder.finish()
+        
+        # --- 4. 最终合并 (Stage C) ---
+        
+        history_exists = os.path.exists(history_output_file) and os.path.getsize(history_output_file) > 0
+        live_exists = os.path.exists(live_output_file) and os.path.getsize(live_output_file) > 0
+
+        if history_exists or live_exists:
+            # ... (与上个版本相同的最终合并逻辑) ...
+            if history_exists and live_exists:
+                print("\n--- 最终合并: 合并历史和实时部分 ---")
+                
+                final_file_list_path = os.path.join(temp_dir, "final_merge_filelist.txt")
+                with open(final_file_list_path, 'w', encoding='utf-8') as f:
+                    f.write(f"file '{os.path.basename(history_output_file)}'\n")
+                    f.write(f"file '{os.path.basename(live_output_file)}'\n")
+                
+                final_merge_command = [
+                    "ffmpeg", 
+                    "-f", "concat", 
+                    "-safe", "0", 
+                    "-i", final_file_list_path, 
+                    "-c", "copy",
+                    final_output_filename
+                ]
+                
+                try:
+                    await async_run_ffmpeg(final_merge_command, cwd=temp_dir)
+                    print(f"\n[成功] 所有部分已合并并保存到最终文件: {final_output_filename}")
+                except subprocess.CalledProcessError as e:
+                    print(f"[严重错误] 最终合并失败。请检查FFmpeg输出。")
+                    print(e.stderr.decode())
+            
+            elif history_exists:
+                if index_builder is not None:
+                    print(f"\n[信息] 历史和实时分片已按顺序写入同一文件，直接移动到: {final_output_filename}")
+                else:
+                    print(f"\n[信息] 未检测到后续直播内容。直接将历史文件移动到: {final_output_filename}")
+                try:
+                    shutil.move(history_output_file, final_output_filename)
+                    print(f"[成功] 文件保存到: {final_output_filename}")
+                except Exception as e:
+                    print(f"[错误] 无法移动历史文件: {e}")
+            
+            elif live_exists:
+                print(f"\n[信息] 历史下载失败，只将直播部分移动到: {final_output_filename}")
+                try:
+                    shutil.move(live_output_file, final_output_filename)
+                    print(f"[成功] 文件保存到: {final_output_filename}")
+                except Exception as e:
+                    print(f"[错误] 无法移动直播文件: {e}")
+
+            # 生成剪辑索引: 已在写入时构建索引时直接保存，否则扫描最终文件
+            if build_index and os.path.exists(final_output_filename):
+                try:
+                    if ts_index is not None and history_exists and not live_exists:
+                        save_ts_index(ts_index, final_output_filename)
+                    else:
+                        await asyncio.get_event_loop().run_in_executor(executor, index_ts_file, final_output_filename)
+                    print(f"[成功] 已生成剪辑索引: {index_path_for(final_output_filename)}")
+                except Exception as e:
+                    print(f"[警告] 生成剪辑索引失败: {e}")
+
+    finally:
+        # 正常结束、提前返回或被取消 (Ctrl+C) 时都停止实时任务、关闭文件并清理临时目录
+        if live_task is not None and not live_task.done():
+            live_task.cancel()
+            await asyncio.gather(live_task, return_exceptions=True)
+        for f in (live_file, spool_file):
+            if f is not None:
+                f.close()
+        if mp4_writer is not None:
+            await mp4_writer.close()
+        
+        # --- 5. 清理 ---
+        try:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+                print(f"\n[清理] 已移除临时目录: {temp_dir}")
+        except Exception as e:
+            print(f"[警告] 无法自动清理临时目录，请手动删除: {temp_dir} ({e})")
+        
+    print("\n程序运行结束。")
+
+def open_segment_store_from_env():
+    """
+    根据环境变量 HLS_SEGMENT_STORE (目录) 和 HLS_SEGMENT_STORE_MAX_GB (容量上限，默认 10 GB)
+    打开共享分片存储。未设置或无法打开时返回 None。
+    """
+    store_dir = os.environ.get("HLS_SEGMENT_STORE")
+    if not store_dir:
+        return None
+    try:
+        max_gb = float(os.environ.get("HLS_SEGMENT_STORE_MAX_GB", "10"))
+        segment_store = SegmentStore(store_dir, max_bytes=int(max_gb * 1024 ** 3))
+    except SegmentStoreBusyError as e:
+        print(f"[警告] {e}，本次将使用普通下载。")
+        return None
+    except Exception as e:
+        print(f"[警告] 无法打开共享分片存储 {store_dir}，将使用普通下载: {e}")
+        return None
+    print(f"[信息] 使用共享分片存储: {store_dir} (上限 {max_gb:g} GB)")
+    return segment_store
+
+def perform_download(stream, cookie=None, suggested_filename=None):
+    """
+    同步调用 async_perform_download，作为程序的主要入口。
+    设置环境变量 HLS_SEGMENT_STORE 可启用共享分片存储 (见 open_segment_store_from_env)。
+    设置 HLS_BUILD_INDEX=1 时为最终文件生成剪辑索引。
+    保存路径以 .mp4 结尾时，边下载边封装为 fragmented MP4。
+    """
+    segment_store = open_segment_store_from_env()
+    
+    default_filename = default_download_filename(stream, suggested_filename)
+    output_path = input(f"\n请输入完整的保存路径和文件名 (默认为当前目录下的 {default_filename}): ").strip()
+    
+    try:
+        # 使用 asyncio.run 执行异步函数
+        asyncio.run(async_perform_download(stream, cookie, suggested_filename, segment_store=segment_store,
+                                           output_filename=output_path or default_filename,
+                                           build_index=os.environ.get("HLS_BUILD_INDEX") == "1"))
+    except KeyboardInterrupt:
+        print("\n[中断] 用户手动停止下载。")
+    except Exception as e:
+        print(f"\n[致命错误] 程序运行出错: {e}")
+    finally:
+        if segment_store is not None:
+            segment_store.close()
+
+# --- 库接口: 异步分片迭代器 ---
+
+class MediaSegment:
+    """iter_segments 产出的单个分片"""
+    def __init__(self, sequence, duration, url, program_date_time, data, fetched_at):
+        self.sequence = sequence                    # 媒体序号 (EXT-X-MEDIA-SEQUENCE 起算)
+        self.duration = duration                    # 时长 (秒)
+        self.url = url
+        self.program_date_time = program_date_time  # 分片起始的墙上时间 (UNIX 时间戳)，播放列表未提供时为 None
+        self.data = data                            # 分片内容 (bytes)
+        self.fetched_at = fetched_at                # 下载完成时间 (UNIX 时间戳)
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def open(self):
+        """以只读文件对象的形式访问分片内容"""
+        return io.BytesIO(self.data)
+
+    def __repr__(self):
+        return f"MediaSegment(sequence={self.sequence}, duration={self.duration}, size={self.size})"
+
+def http_get(url, cookie=None, timeout=10):
+    """同步 GET 请求，返回响应内容 (bytes)"""
+    req = urllib.request.Request(url)
+    if cookie:
+        req.add_header('Cookie', cookie)
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return response.read()
+
+def highest_bandwidth_variant(streams):
+    """默认的子流选择策略: 码率最高的子流"""
+    return max(streams, key=lambda s: float(s.bandwidth.split()[0]))
+
+async def iter_segments(playlist_url, cookie=None, start_sequence=None, live_edge=False,
+                        max_prefetch=4, segment_store=None, select_variant=highest_bandwidth_variant,
+                        max_retries=3, timeout=10, skip_failed=True, max_refresh_failures=10, executor=None):
+    """
+    按序号顺序异步产出 MediaSegment，适合在进程内直接消费分片 (无临时文件、无 FFmpeg)。
+
+    参数:
+        playlist_url: 主播放列表或媒体播放列表 URL；主播放列表由 select_variant 选择子流
+        start_sequence: 从该序号开始 (含)；默认从播放列表中最早的分片开始
+        live_edge: 为 True 时从当前最新的分片开始 (类似 FFmpeg -live_start_index -1)
+        max_prefetch: 最多提前下载的分片数。消费者处理慢时下载随之暂停 (背压)
+        segment_store: 可选的 SegmentStore，分片经由共享存储读取/写入
+        skip_failed: 分片重试 max_retries 次仍失败时跳过；为 False 时抛出异常
+        max_refresh_failures: 播放列表连续获取失败达到该次数时抛出异常；
+            此前按指数退避 (最长 30 秒) 重试，期间继续产出已在下载的分片
+        executor: 执行网络请求的线程池；默认为本次迭代单独创建 (max_prefetch + 1 个线程)，
+            播放列表刷新不会排在其他任务的下载请求之后
+
+    直播流会按 TARGETDURATION 的一半刷新播放列表，遇到 EXT-X-ENDLIST 后结束。
+    媒体序号回退到上一个播放列表窗口之前时 (推流重启)，从新播放列表的第一个分片重新同步。
+    本函数不打印、不交互，分片内容按原样返回 (不处理加密)。
+    """
+    loop = asyncio.get_running_loop()
+    own_executor = None
+    if executor is None:
+        executor = own_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_prefetch + 1)
+    
+    async def fetch(url):
+        return await loop.run_in_executor(executor, http_get, url, cookie, timeout)
+    
+    async def fetch_playlist(url):
+        """首次获取播放列表，失败时按指数退避重试"""
+        for attempt in range(max_refresh_failures):
+            try:
+                return (await fetch(url)).decode('utf-8')
+            except Exception:
+                if attempt == max_refresh_failures - 1:
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30))
+    
+    async def fetch_segment(sequence, duration, url, pdt):
+        for attempt in range(max_retries):
+            try:
+                if segment_store is not None:
+                    data, _ = await loop.run_in_executor(
+                        executor, segment_store.fetch, url, lambda: http_get(url, cookie, timeout))
+                else:
+                    data = await fetch(url)
+                return MediaSegment(sequence, duration, url, pdt, data, time.time())
+            except Exception:
+                if attempt == max_retries - 1:
+                    raise
+                await asyncio.sleep(1)
+    
+    pending = collections.deque()  # 按序号排列的 (序号, 下载任务)
+    queued = collections.deque()   # 已知但尚未开始下载的分片
+    next_sequence = start_sequence
+    last_refresh = time.monotonic()
+    refresh_failures = 0
+    previous_media_sequence = None
+    
+    try:
+        content = await fetch_playlist(playlist_url)
+        media_url = playlist_url
+        if '#EXT-X-STREAM-INF' in content:
+            media_url = select_variant(parse_m3u8_string(content, base_url=playlist_url)).url
+            content = await fetch_playlist(media_url)
+        
+        while True:
+            playlist = parse_media_playlist(content, base_url=media_url)
+            if next_sequence is None:
+                if live_edge and playlist.segments:
+                    next_sequence = playlist.segments[-1][0]
+                else:
+                    next_sequence = playlist.media_sequence
+            elif (previous_media_sequence is not None and playlist.segments
+                    and playlist.segments[-1][0] < previous_media_sequence):
+                # 整个窗口都在上一个窗口之前 (不是 CDN 返回的稍旧的列表)，说明推流重启、序号被重置
+                next_sequence = playlist.media_sequence
+            previous_media_sequence = playlist.media_sequence
+            for segment_info in playlist.segments:
+                if segment_info[0] >= next_sequence:
+                    queued.append(segment_info)
+                    next_sequence = segment_info[0] + 1
+            
+            while pending or queued:
+                while queued and len(pending) < max_prefetch:
+                    segment_info = queued.popleft()
+                    pending.append((segment_info[0], asyncio.ensure_future(fetch_segment(*segment_info))))
+                
+                _, task = pending.popleft()
+                try:
+                    segment = await task
+                except Exception:
+                    if not skip_failed:
+                        raise
+                    continue
+                yield segment
+                
+                # 直播流: 已知分片即将耗尽时刷新播放列表，保持预取窗口不空
+                if not playlist.endlist and not queued:
+                    break
+            
+            if playlist.endlist and not pending and not queued:
+                return
+            
+            refresh_interval = (playlist.target_duration or 2) / 2
+            if refresh_failures:
+                # 刷新失败后按指数退避，期间继续产出已在下载的分片
+                refresh_interval = min(refresh_interval * 2 ** refresh_failures, 30)
+            wait = refresh_interval - (time.monotonic() - last_refresh)
+            if wait > 0 and not pending:
+                await asyncio.sleep(wait)
+            if time.monotonic() - last_refresh >= refresh_interval or not pending:
+                try:
+                    content = (await fetch(media_url)).decode('utf-8')
+                    refresh_failures = 0
+                except Exception:
+                    refresh_failures += 1
+                    if refresh_failures >= max_refresh_failures:
+                        raise
+                last_refresh = time.monotonic()
+    finally:
+        for _, task in pending:
+            task.cancel()
+        if own_executor is not None:
+            own_executor.shutdown(wait=False, cancel_futures=True)
+
+# --- 直播回看 (DVR) 环形缓冲区 ---
+
+class DvrEntry:
+    """环形缓冲区中的一个分片"""
+    __slots__ = ("sequence", "duration", "start_time", "offset", "length", "alive")
+
+    def __init__(self, sequence, duration, start_time, offset, length):
+        self.sequence = sequence
+        self.duration = duration
+        self.start_time = start_time  # 分片起始墙上时间 (UNIX 时间戳)
+        self.offset = offset
+        self.length = length
+        self.alive = True
+
+    @property
+    def end_time(self):
+        return self.start_time + self.duration
+
+class DvrRingBuffer:
+    """
+    保存最近 max_seconds 秒直播分片的环形缓冲区，可随时按墙上时间导出片段。
+
+    分片字节按写入顺序循环写入一块容量为 max_bytes 的区域 (内存 bytearray，
+    或提供 spool_path 时使用磁盘文件)，被覆盖或超出时长窗口的分片自动淘汰。
+    分片按 PROGRAM-DATE-TIME 和媒体序号索引；播放列表未提供 PROGRAM-DATE-TIME 时
+    按下载时间和分片时长推算。
+
+    导出时只在复制单个分片期间持有锁，不会暂停写入。
+    """
+    def __init__(self, max_seconds=600, max_bytes=1024 ** 3, spool_path=None):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.spool_path = spool_path
+        
+        self._entries = collections.deque()
+        self._write_pos = 0
+        self._lock = threading.Lock()
+        if spool_path:
+            self._buffer = None
+            self._file = open(spool_path, 'w+b')
+        else:
+            self._buffer = bytearray()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._entries.clear()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                try:
+                    os.remove(self.spool_path)
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def start_time(self):
+        """缓冲区中最早分片的起始时间，缓冲区为空时为 None"""
+        entries = self._entries
+        return entries[0].start_time if entries else None
+
+    @property
+    def end_time(self):
+        """缓冲区中最新分片的结束时间，缓冲区为空时为 None"""
+        entries = self._entries
+        return entries[-1].end_time if entries else None
+
+    def add(self, segment):
+        """写入一个 MediaSegment。分片大于整个缓冲区时忽略并返回 False。"""
+        data = segment.data
+        length = len(data)
+        if length == 0 or length > self.max_bytes:
+            return False
+        
+        with self._lock:
+            entries = self._entries
+            start_time = segment.program_date_time
+            if start_time is None:
+                last = entries[-1] if entries else None
+                if last is not None and segment.sequence == last.sequence + 1:
+                    start_time = last.end_time
+                else:
+                    start_time = segment.fetched_at - segment.duration
+            
+            pos = self._write_pos
+            if pos + length > self.max_bytes:
+                # 回到开头；上一圈尾部剩余的分片比即将覆盖的分片更早，一并淘汰
+                while entries and entries[0].offset >= pos:
+                    entries.popleft().alive = False
+                pos = 0
+            while entries and entries[0].offset < pos + length and entries[0].offset + entries[0].length > pos:
+                entries.popleft().alive = False
+            
+            if self._file is not None:
+                self._file.seek(pos)
+                self._file.write(data)
+            else:
+                self._buffer[pos:pos + length] = data
+            self._write_pos = pos + length
+            
+            entry = DvrEntry(segment.sequence, segment.duration, start_time, pos, length)
+            entries.append(entry)
+            while entries and entry.end_time - entries[0].start_time > self.max_seconds:
+                entries.popleft().alive = False
+        return True
+
+    def _read_entry(self, entry):
+        """读取分片内容；分片在此期间被淘汰时返回 None"""
+        with self._lock:
+            if not entry.alive:
+                return None
+            if self._file is not None:
+                self._file.seek(entry.offset)
+                return self._file.read(entry.length)
+            return bytes(self._buffer[entry.offset:entry.offset + entry.length])
+
+    def entries_between(self, start_time, end_time):
+        """返回与墙上时间区间 [start_time, end_time) 有重叠的分片"""
+        with self._lock:
+            return [e for e in self._entries if e.end_time > start_time and e.start_time < end_time]
+
+    def entries_by_sequence(self, first_sequence, last_sequence):
+        """返回序号在 [first_sequence, last_sequence] 内的分片"""
+        with self._lock:
+            return [e for e in self._entries if first_sequence <= e.sequence <= last_sequence]
+
+    def export(self, entries, output_path):
+        """
+        按顺序将分片原样拼接写入 output_path (不重新编码)。
+        返回 (写入的分片数, 实际起始时间, 实际结束时间)；没有可导出的分片时返回 (0, None, None)。
+        """
+        count = 0
+        first_start = None
+        last_end = None
+        with open(output_path, 'wb') as out_file:
+            for entry in entries:
+                data = self._read_entry(entry)
+                if data is None:
+                    continue
+                out_file.write(data)
+                count += 1
+                if first_start is None:
+                    first_start = entry.start_time
+                last_end = entry.end_time
+        return count, first_start, last_end
+
+    def export_clip(self, start_time, end_time, output_path):
+        """导出墙上时间区间 [start_time, end_time) 的片段 (按分片边界对齐)"""
+        return self.export(self.entries_between(start_time, end_time), output_path)
+
+async def record_dvr(playlist_url, dvr, cookie=None, **kwargs):
+    """从直播最新位置开始持续将分片写入 DVR 缓冲区，直到直播结束或任务被取消"""
+    kwargs.setdefault("live_edge", True)
+    async for segment in iter_segments(playlist_url, cookie=cookie, **kwargs):
+        dvr.add(segment)
+
+def parse_clip_time(value, reference=None):
+    """
+    将 HH:MM[:SS] (本地时间) 解析为不晚于 reference (UNIX 时间戳，默认当前时间) 的最近一次该时刻，
+    因此跨过午夜的时间也能正确对应到前一天。
+    """
+    if reference is None:
+        reference = time.time()
+    parts = [int(x) for x in value.split(':')]
+    if len(parts) == 2:
+        parts.append(0)
+    if len(parts) != 3:
+        raise ValueError(f"无效的时间: {value}")
+    hour, minute, second = parts
+    moment = datetime.datetime.fromtimestamp(reference).replace(hour=hour, minute=minute, second=second, microsecond=0)
+    if moment.timestamp() > reference:
+        moment -= datetime.timedelta(days=1)
+    return moment.timestamp()
+
+def parse_clip_range(start_value, end_value, reference=None):
+    """
+    解析 HH:MM[:SS] 形式的片段起止时间。起点取不晚于 reference (通常为缓冲区最新时间) 的最近一次，
+    终点取起点之后的第一次，例如 23:59:50 到 00:00:10 表示跨过午夜的 20 秒。
+    """
+    start_time = parse_clip_time(start_value, reference)
+    end_time = parse_clip_time(end_value, start_time + 86400)
+    return start_time, end_time
+
+class ConsoleReader:
+    """
+    在守护线程中读取标准输入，供事件循环 await。
+    不用 run_in_executor(input): 阻塞在 input() 上的线程池线程会让 asyncio.run 退出时一直等到用户按回车。
+    也不经过 sys.stdin: 守护线程持有其缓冲区的锁时，解释器退出会报致命错误，因此直接读取文件描述符。
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self._requests = queue.SimpleQueue()
+        self._thread = None
+
+    async def readline(self, prompt=""):
+        future = self.loop.create_future()
+        self._requests.put((prompt, future))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return await future
+
+    def _run(self):
+        pending = b""
+        while True:
+            prompt, future = self._requests.get()
+            print(prompt, end='', flush=True)
+            result, error = None, None
+            try:
+                while b"\n" not in pending:
+                    chunk = os.read(sys.stdin.fileno(), 4096)
+                    if not chunk:
+                        break
+                    pending += chunk
+                if pending:
+                    line, _, pending = pending.partition(b"\n")
+                    result = line.decode(sys.stdin.encoding or 'utf-8', errors='replace').rstrip('\r')
+                else:
+                    error = EOFError()
+            except Exception as e:
+                error = e
+            try:
+                self.loop.call_soon_threadsafe(self._deliver, future, result, error)
+            except RuntimeError:
+                return  # 事件循环已关闭
+
+    @staticmethod
+    def _deliver(future, result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+async def async_perform_dvr(stream, cookie=None, max_seconds=600, output_filename=None, segment_store=None):
     """
-    异步下载单个分片，失败重试 max_retries 次，并在下载前检查本地是否存在。
-    返回: (成功状态, 文件路径, 是否跳过)
+    直播回看模式: 后台用 async_perform_download 正常录制，实时分片与历史分片同时下载并写入回看缓冲区，
+    前台根据命令随时导出最近的片段。退出时停止录制并保存已下载的部分。
     """
+    spool_path = os.environ.get("HLS_DVR_SPOOL")
+    # 按流码率估算缓冲区大小，留出 50% 余量
+    try:
+        bandwidth = float(stream.bandwidth.split()[0]) * 1000000
+    except (ValueError, IndexError):
+        bandwidth = 0
+    max_bytes = max(64 * 1024 ** 2, int(bandwidth / 8 * max_seconds * 1.5))
     
-    # * 断点续传/存在性检查 *
-    if os.path.exists(ts_local_path) and os.path.getsize(ts_local_path) > 0:
-        return True, ts_local_path, True # 成功，已跳过
+    dvr = DvrRingBuffer(max_seconds=max_seconds, max_bytes=max_bytes, spool_path=spool_path)
+    loop = asyncio.get_running_loop()
+    console = ConsoleReader(loop)
+    ingest = asyncio.ensure_future(async_perform_download(stream, cookie, output_filename=output_filename,
+                                                          segment_store=segment_store, dvr=dvr))
     
-    # 如果文件不存在，则开始下载
-    for attempt in range(max_retries):
-        try:
-            # 使用 urllib.request 进行同步下载的包装器 (在线程池中运行)
-            def sync_fetch():
-                req = urllib.request.Request(ts_url)
-                if cookie:
-                    req.add_header('Cookie', cookie)
-                
-                with urllib.request.urlopen(req, timeout=10) as response: 
-                    # 写入文件
-                    with open(ts_local_path, 'wb') as out_file:
-                        out_file.write(response.read())
+    print(f"\n[DVR] 缓存最近 {max_seconds // 60} 分钟的直播内容 (上限 {max_bytes / 1024 ** 2:.0f} MB)，与历史分片同时开始。")
+    print("命令: clip <秒数>            导出最近 N 秒")
+    print("      clip <HH:MM:SS> <HH:MM:SS>  导出指定时间段")
+    print("      status                  查看缓冲区状态")
+    print("      q                       退出")
+    
+    ingest_reported = False
+    try:
+        while True:
+            command = (await console.readline("DVR> ")).strip()
+            if ingest.done() and not ingest_reported:
+                ingest_reported = True
+                error = None if ingest.cancelled() else ingest.exception()
+                print(f"[信息] 录制已结束{f' ({error})' if error else ''}，仍可导出缓冲区中的内容。")
             
-            # 阻塞调用，但放入线程池中运行，不阻塞事件循环
-            await asyncio.get_event_loop().run_in_executor(None, sync_fetch) 
-            return True, ts_local_path, False # 成功，未跳过
-        
-        except Exception as e:
-            if attempt < max_retries - 1:
-                # print(f"\n[警告] 分片 {os.path.basename(ts_local_path)} 下载失败 (第 {attempt + 1} 次)，正在重试...")
-                await asyncio.sleep(5) # 重试前等待 5 秒
+            if command in ('q', 'quit', 'exit'):
+                break
+            fields = command.split()
+            if not fields:
+                continue
+            
+            if fields[0] == 'status':
+                if len(dvr) == 0:
+                    print("[DVR] 缓冲区为空 (尚未下载到直播分片)。")
+                else:
+                    start = time.strftime('%H:%M:%S', time.localtime(dvr.start_time))
+                    end = time.strftime('%H:%M:%S', time.localtime(dvr.end_time))
+                    print(f"[DVR] {len(dvr)} 个分片，时间范围 {start} - {end}")
+            elif fields[0] == 'clip' and len(fields) in (2, 3):
+                try:
+                    if len(fields) == 2:
+                        end_time = dvr.end_time or time.time()
+                        start_time = end_time - float(fields[1])
+                    else:
+                        start_time, end_time = parse_clip_range(fields[1], fields[2], dvr.end_time)
+                except ValueError:
+                    print("[警告] 时间格式无效。")
+                    continue
+                
+                output_path = os.path.join(os.getcwd(), f"DVR_clip_{time.strftime('%Y%m%d_%H%M%S')}.ts")
+                count, clip_start, clip_end = await loop.run_in_executor(
+                    None, dvr.export_clip, start_time, end_time, output_path)
+                if count == 0:
+                    os.remove(output_path)
+                    print("[警告] 缓冲区中没有该时间段的内容。")
+                else:
+                    print(f"[成功] 已导出 {count} 个分片 ({clip_end - clip_start:.1f} 秒) 到: {output_path}")
             else:
-                # print(f"\n[严重警告] 分片 {os.path.basename(ts_local_path)} 最终下载失败，跳过。错误: {e}")
-                return False, ts_local_path, False # 最终失败，未跳过
-
-    return False, ts_local_path, False
+                print("[警告] 无法识别的命令。")
+    finally:
+        if not ingest.done():
+            print("[信息] 正在停止录制并保存已下载的部分...")
+        ingest.cancel()
+        try:
+            await ingest
+        except BaseException:
+            pass
+        dvr.close()
 
-async def async_perform_download(stream, cookie=None, suggested_filename=None):
+def perform_dvr(stream, cookie=None, suggested_filename=None):
     """
-    三阶段下载与合并 (异步并发下载历史分片，FFmpeg 下载实时分片)
+    同步调用 async_perform_dvr (录制到文件，同时开启直播回看)。
+    设置环境变量 HLS_DVR_SPOOL (文件路径) 时，缓冲区存放在磁盘而不是内存中；
+    HLS_SEGMENT_STORE 的含义与下载模式相同。
     """
-    if not check_ffmpeg(): return
-    
-    # --- 0. 初始化和路径设置 ---
-    if suggested_filename:
-        # 清理文件名中的非法字符（跨平台处理）
-        # Windows非法字符: < > : " / \ | ? *
-        # Linux非法字符: / 和 null
-        # 使用平台无关的清理方式
-        suggested_filename = re.sub(r'[<>:"/|?*\\]', '_', suggested_filename)
-        # 移除控制字符和null字符
-        suggested_filename = re.sub(r'[\x00-\x1f\x7f]', '_', suggested_filename)
-        default_filename = f"{suggested_filename}_{stream.resolution}.ts"
-    else:
-        default_filename = f"HLS_Stream_FULL_{stream.resolution}_{stream.bandwidth.replace(' ', '_').replace('.', 'p')}.ts"
-    output_path = input(f"\n请输入完整的保存路径和文件名 (默认为当前目录下的 {default_filename}): ").strip()
-    final_output_filename = output_path if output_path else default_filename
-    
-    # 确保使用绝对路径，避免路径问题
-    if not os.path.isabs(final_output_filename):
-        final_output_filename = os.path.join(os.getcwd(), final_output_filename)
-    
-    temp_dir = os.path.join(os.path.dirname(final_output_filename), f"temp_hls_download_{int(time.time())}")
-    base_name = os.path.splitext(os.path.basename(final_output_filename))[0]
-    history_output_file = os.path.join(temp_dir, f"{base_name}_0.ts")
-    live_output_file = os.path.join(temp_dir, f"{base_name}_1.ts")
-    
-    print(f"\n[开始] 正在开始三阶段下载，最终文件：{final_output_filename}")
-    print(f"[信息] 所有临时文件将存储在: {temp_dir}")
+    minutes = input("请输入回看缓冲时长 (分钟，默认 10): ").strip()
+    try:
+        max_seconds = int(float(minutes) * 60) if minutes else 600
+    except ValueError:
+        print("[警告] 输入无效，使用默认的 10 分钟。")
+        max_seconds = 600
     
-    download_success = True
+    default_filename = default_download_filename(stream, suggested_filename)
+    output_path = input(f"\n请输入录像的保存路径和文件名 (默认为当前目录下的 {default_filename}): ").strip()
+    segment_store = open_segment_store_from_env()
     
     try:
-        os.makedirs(temp_dir, exist_ok=True)
+        asyncio.run(async_perform_dvr(stream, cookie, max_seconds, output_filename=output_path or default_filename,
+                                      segment_store=segment_store))
+    except KeyboardInterrupt:
+        print("\n[中断] 用户手动停止回看。")
     except Exception as e:
-        print(f"[错误] 无法创建临时目录 {temp_dir}: {e}")
-        return
+        print(f"\n[致命错误] 程序运行出错: {e}")
+    finally:
+        if segment_store is not None:
+            segment_store.close()
 
-    # --- 1. 阶段 1/3: 准备工作 (M3U8 解析) ---
-    print("\n--- 阶段 1/3: 准备工作 (解析流信息) ---")
-    
-    # ---------------------------------------------------------------------
-    # 同步 M3U8 解析代码 (与上一个版本保持一致)
-    # ---------------------------------------------------------------------
-    top_level_url = stream.url 
-    final_stream_url = top_level_url
+# --- TS 关键帧索引与快速剪辑 ---
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+PTS_WRAP = 1 << 33
+# PMT 中的视频流类型: MPEG-2 / H.264 / HEVC
+VIDEO_STREAM_TYPES = {0x02: "mpeg2", 0x1B: "h264", 0x24: "hevc"}
+H264_KEYFRAME_NAL_TYPES = {5}                       # IDR
+H264_SLICE_NAL_TYPES = {1, 2, 3, 4, 5}               # 编码片 (VCL)
+HEVC_KEYFRAME_NAL_TYPES = {16, 17, 18, 19, 20, 21}  # IRAP: BLA / IDR / CRA
+HEVC_SLICE_NAL_TYPES = set(range(32))                # VCL
+KEYFRAME_PROBE_PACKETS = 16  # 判断关键帧时最多检查每个 PES 的前若干个 TS 包
+MAX_PTS_GAP = 30 * 90000     # 相邻分片的 PTS 间隔超出该范围 (或回退) 时视为时间戳跳变
+
+def read_pes_pts(payload):
+    """从 PES 包头读取 PTS (90kHz)，没有 PTS 时返回 None"""
+    if len(payload) < 14 or payload[0] != 0 or payload[1] != 0 or payload[2] != 1:
+        return None
+    if not payload[7] & 0x80:
+        return None
+    b = payload[9:14]
+    return ((b[0] >> 1) & 0x07) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+
+def payload_is_keyframe(payload, codec):
+    """
+    根据 PES 负载中第一个编码片 NAL 单元判断是否为关键帧:
+    H.264 为 IDR (5)，HEVC 为 IRAP (16-21)。
+    负载中没有编码片 (例如参数集/SEI 较长，编码片在后续 TS 包中) 或编码格式不是 H.264/HEVC 时返回 None，
+    由调用方继续检查后续负载或改用 random_access_indicator 判断。
+    """
+    if codec == "h264":
+        keyframe_types, slice_types = H264_KEYFRAME_NAL_TYPES, H264_SLICE_NAL_TYPES
+    elif codec == "hevc":
+        keyframe_types, slice_types = HEVC_KEYFRAME_NAL_TYPES, HEVC_SLICE_NAL_TYPES
+    else:
+        return None
     
-    try:
-        req = urllib.request.Request(top_level_url)
-        if cookie:
-            req.add_header('Cookie', cookie)
-        with urllib.request.urlopen(req) as response:
-            top_m3u8_content = response.read().decode('utf-8')
+    pos = payload.find(b'\x00\x00\x01')
+    while pos != -1 and pos + 3 < len(payload):
+        header = payload[pos + 3]
+        nal_type = header & 0x1F if codec == "h264" else (header >> 1) & 0x3F
+        if nal_type in slice_types:
+            return nal_type in keyframe_types
+        pos = payload.find(b'\x00\x00\x01', pos + 3)
+    return None
+
+class TsIndexBuilder:
+    """
+    随字节流逐步构建 MPEG-TS 旁路索引。
+
+    记录: 每个分片在最终文件中的字节偏移和 PTS 范围、每个关键帧所在 PES 的起始包偏移和 PTS、
+    分片的墙上时间，以及第一个 PAT/PMT 包的位置 (剪辑时写在片段开头)。
+
+    下载时由调用方在每个分片前调用 begin_segment (传入 PROGRAM-DATE-TIME)；
+    segment_at_keyframes 为 True 时 (扫描已有文件，没有分片边界) 改为在每个关键帧处自动分段。
+    finish() 时没有墙上时间的分片按 PTS 从最近的有墙上时间的分片推算。
+    """
+    def __init__(self, segment_at_keyframes=False):
+        self.segment_at_keyframes = segment_at_keyframes
+        self.offset = 0             # 已处理的字节数
+        self.segments = []          # [{"sequence", "offset", "length", "pts_start", "pts_end", "wall_time"}]
+        self.keyframes = []         # [(字节偏移, PTS)]
+        self.pat_offset = None
+        self.pmt_offset = None
+        self.pmt_pid = None
+        self.video_pid = None
+        self.codec = None
         
-        sub_streams = parse_m3u8_string(top_m3u8_content, base_url=top_level_url)
-        user_bandwidth_raw = int(float(stream.bandwidth.split()[0]) * 1000000) 
-        selected_sub_stream_url = None
+        self._pending = b''
+        self._last_pts = None
+        self._pts_base = 0
+        self._current = None
+        self._probe = None          # 尚未判断是否为关键帧的 PES: [偏移, PTS, random_access, ES 字节, 已检查包数]
+
+    def begin_segment(self, sequence=None, duration=None, wall_time=None):
+        """标记一个新分片的开始，之后 feed 的字节都属于该分片"""
+        self._resolve_probe()
+        self._start_segment(self.offset - len(self._pending), sequence, duration, wall_time)
+
+    def _start_segment(self, offset, sequence=None, duration=None, wall_time=None):
+        self._close_segment(offset)
+        self._current = {"sequence": sequence, "offset": offset, "length": 0,
+                         "duration": duration, "pts_start": None, "pts_end": None, "wall_time": wall_time}
+
+    def _close_segment(self, end_offset):
+        if self._current is not None:
+            self._current["length"] = end_offset - self._current["offset"]
+            self.segments.append(self._current)
+            self._current = None
+
+    def feed(self, data):
+        """处理一段字节 (长度不必是 188 的整数倍)"""
+        if self._pending:
+            data = self._pending + data
+        base = self.offset - len(self._pending)
+        end = len(data) - TS_PACKET_SIZE
+        i = 0
         
-        for s in sub_streams:
-            s_bandwidth_raw = 0
-            try:
-                s_bandwidth_raw = int(float(s.bandwidth.split()[0]) * 1000000)
-            except:
-                pass
-            
-            resolution_match = (s.resolution == stream.resolution)
-            bandwidth_match = abs(s_bandwidth_raw - user_bandwidth_raw) < 10000 
-            
-            if resolution_match and bandwidth_match:
-                selected_sub_stream_url = s.url
-                break
+        if self._probe is not None:
+            # 上一段数据末尾的 PES 还未判断出是否为关键帧
+            self._continue_probe(data, 0)
         
-        if selected_sub_stream_url:
-            final_stream_url = selected_sub_stream_url
-            print(f"[信息] 成功找到子流 URL: {final_stream_url}")
-        else:
-            print(f"[警告] 未能找到匹配的子流 URL。假定用户选择的 URL 本身 ({top_level_url[:50]}...) 即为子流播放列表。")
-            final_stream_url = top_level_url
-
-        req = urllib.request.Request(final_stream_url)
-        if cookie:
-            req.add_header('Cookie', cookie)
-        with urllib.request.urlopen(req) as response:
-            live_m3u8_content = response.read().decode('utf-8')
+        if self.video_pid is not None and data[0] == TS_SYNC_BYTE:
+            # 快速路径: 所有包都已对齐时，只需用 find 定位视频 PES 起始包，无需逐包循环
+            count = len(data) // TS_PACKET_SIZE
+            if data[0:count * TS_PACKET_SIZE:TS_PACKET_SIZE].count(TS_SYNC_BYTE) == count:
+                starts = []
+                for marker_flags in (0x40, 0x60):  # PUSI (以及带 transport_priority 的情况)
+                    marker = bytes([TS_SYNC_BYTE, marker_flags | (self.video_pid >> 8), self.video_pid & 0xFF])
+                    pos = data.find(marker)
+                    while pos != -1 and pos <= end:
+                        if pos % TS_PACKET_SIZE == 0:
+                            starts.append(pos)
+                        pos = data.find(marker, pos + 1)
+                for pos in sorted(starts):
+                    self._on_video_pes_start(data, pos, base + pos)
+                i = count * TS_PACKET_SIZE
+        
+        while i <= end:
+            if data[i] != TS_SYNC_BYTE:
+                # 失去同步，寻找下一个同步字节
+                i = data.find(b'\x47', i + 1)
+                if i == -1:
+                    i = len(data)
+                    break
+                continue
             
-        ts_url_pattern = re.compile(r'index_(\d)_(\d+)\.ts(\?m=\d+)')
-        last_index = -1
-        last_segment_url = None
+            pid = ((data[i + 1] & 0x1F) << 8) | data[i + 2]
+            if pid == self.video_pid:
+                if data[i + 1] & 0x40:
+                    self._on_video_pes_start(data, i, base + i)
+            elif pid == 0 or pid == self.pmt_pid:
+                self._on_psi(data, i, pid, base + i)
+            i += TS_PACKET_SIZE
         
-        for line in live_m3u8_content.splitlines():
-            line = line.strip()
-            ts_match = ts_url_pattern.search(line)
-            if ts_match:
-                current_index = int(ts_match.group(2))
-                if current_index > last_index:
-                    last_index = current_index
-                    last_segment_url = line 
+        self._pending = data[i:]
+        self.offset = base + len(data)
+
+    def finish(self):
+        """结束构建，返回可序列化为 JSON 的索引"""
+        self._resolve_probe()
+        self._close_segment(self.offset)
+        self._fill_wall_times()
+        return {
+            "version": 1,
+            "file_size": self.offset,
+            "codec": self.codec,
+            "video_pid": self.video_pid,
+            "pat_offset": self.pat_offset,
+            "pmt_offset": self.pmt_offset,
+            "segments": self.segments,
+            "keyframes": self.keyframes,
+        }
+
+    def _fill_wall_times(self):
+        """没有墙上时间的分片按时间轴 (segment_start_times) 从最近的有墙上时间的分片推算"""
+        anchors = [i for i, segment in enumerate(self.segments)
+                   if segment["wall_time"] is not None and segment["pts_start"] is not None]
+        if not anchors:
+            return
+        starts = segment_start_times(self.segments)
+        for i, segment in enumerate(self.segments):
+            if segment["wall_time"] is not None or segment["pts_start"] is None:
+                continue
+            position = bisect.bisect_left(anchors, i)
+            candidates = anchors[max(position - 1, 0):position + 1]
+            anchor = min(candidates, key=lambda a: abs(a - i))
+            segment["wall_time"] = self.segments[anchor]["wall_time"] + starts[i] - starts[anchor]
+
+    @staticmethod
+    def _payload(data, i):
+        """返回 TS 包的负载以及 random_access_indicator"""
+        flags = data[i + 3]
+        start = i + 4
+        random_access = False
+        if flags & 0x20:
+            af_length = data[i + 4]
+            if af_length > 0:
+                random_access = bool(data[i + 5] & 0x40)
+            start += 1 + af_length
+        if not flags & 0x10:
+            return b'', random_access
+        return data[start:i + TS_PACKET_SIZE], random_access
+
+    def _on_psi(self, data, i, pid, offset):
+        if not data[i + 1] & 0x40:
+            return
+        payload, _ = self._payload(data, i)
+        if not payload:
+            return
+        section = payload[1 + payload[0]:]
+        if len(section) < 12:
+            return
+        section_end = min(len(section), 3 + (((section[1] & 0x0F) << 8) | section[2]) - 4)
         
-        if last_index == -1:
-            print("[错误] 未能在子流 M3U8 中找到可识别的分片 URL 模式。下载中止。")
+        if pid == 0 and section[0] == 0x00 and self.pmt_pid is None:
+            for pos in range(8, section_end - 3, 4):
+                program_number = (section[pos] << 8) | section[pos + 1]
+                if program_number != 0:
+                    self.pmt_pid = ((section[pos + 2] & 0x1F) << 8) | section[pos + 3]
+                    self.pat_offset = offset
+                    break
+        elif pid == self.pmt_pid and section[0] == 0x02 and self.video_pid is None:
+            pos = 12 + (((section[10] & 0x0F) << 8) | section[11])
+            while pos + 5 <= section_end:
+                stream_type = section[pos]
+                es_pid = ((section[pos + 1] & 0x1F) << 8) | section[pos + 2]
+                if stream_type in VIDEO_STREAM_TYPES:
+                    self.video_pid = es_pid
+                    self.codec = VIDEO_STREAM_TYPES[stream_type]
+                    self.pmt_offset = offset
+                    break
+                pos += 5 + (((section[pos + 3] & 0x0F) << 8) | section[pos + 4])
+
+    def _on_video_pes_start(self, data, i, offset):
+        self._resolve_probe()
+        payload, random_access = self._payload(data, i)
+        pts = read_pes_pts(payload)
+        if pts is None:
             return
-            
-        print(f"[信息] 检测到最新的分片索引 N 为: {last_index}。")
-            
-        base_prefix_match = re.search(r'(.*/index_\d+)\.m3u8', final_stream_url)
         
-        if not base_prefix_match:
-            final_stream_dir = final_stream_url.rsplit('/', 1)[0]
-            index_match = re.search(r'(index_\d+)', last_segment_url)
-            if index_match:
-                 base_prefix = f"{final_stream_dir}/{index_match.group(1)}"
-            else:
-                print("[严重错误] 无法从 URL 构造分片基础前缀。下载中止。")
-                return
+        # 展开 33 位 PTS 回绕
+        if self._last_pts is not None and pts + self._pts_base < self._last_pts - PTS_WRAP // 2:
+            self._pts_base += PTS_WRAP
+        pts += self._pts_base
+        self._last_pts = pts
+        
+        es = payload[9 + payload[8]:]
+        keyframe = payload_is_keyframe(es, self.codec)
+        if keyframe is None and self.codec in ("h264", "hevc"):
+            # 编码片不在第一个 TS 包中，继续检查同一 PES 的后续包
+            self._probe = [offset, pts, random_access, es, 1]
+            self._continue_probe(data, i + TS_PACKET_SIZE)
+            return
+        self._on_video_frame(offset, pts, random_access if keyframe is None else keyframe)
+
+    def _continue_probe(self, data, i):
+        """从 data[i] 开始把同一 PES 的后续负载加入待判断的 ES，能判断或遇到下一个 PES 时结束"""
+        probe = self._probe
+        end = len(data) - TS_PACKET_SIZE
+        while i <= end:
+            if data[i] != TS_SYNC_BYTE:
+                break
+            if ((data[i + 1] & 0x1F) << 8) | data[i + 2] == self.video_pid:
+                if data[i + 1] & 0x40:
+                    break
+                payload, _ = self._payload(data, i)
+                probe[3] += payload
+                probe[4] += 1
+                keyframe = payload_is_keyframe(probe[3], self.codec)
+                if keyframe is not None or probe[4] >= KEYFRAME_PROBE_PACKETS:
+                    self._resolve_probe(keyframe)
+                    return
+            i += TS_PACKET_SIZE
         else:
-             base_prefix = base_prefix_match.group(1) 
+            # 数据已用完，等待下一次 feed
+            return
+        self._resolve_probe()
+
+    def _resolve_probe(self, keyframe=None):
+        """结束待判断的 PES；仍无法从 NAL 判断时使用 random_access_indicator"""
+        probe = self._probe
+        if probe is None:
+            return
+        self._probe = None
+        self._on_video_frame(probe[0], probe[1], probe[2] if keyframe is None else keyframe)
+
+    def _on_video_frame(self, offset, pts, keyframe):
+        if keyframe and self.segment_at_keyframes:
+            current = self._current
+            if current is None:
+                # 第一个自动分段从文件开头开始，包含之前的 PAT/PMT
+                self._start_segment(0, sequence=0)
+            elif current["pts_start"] is not None:
+                self._start_segment(offset, sequence=len(self.segments) + 1)
         
-        url_suffix_match = re.search(r'(\.ts\?m=\d+)', last_segment_url)
-        url_suffix = url_suffix_match.group(1) if url_suffix_match else ".ts"
+        current = self._current
+        if current is not None:
+            if current["pts_start"] is None or pts < current["pts_start"]:
+                current["pts_start"] = pts
+            if current["pts_end"] is None or pts > current["pts_end"]:
+                current["pts_end"] = pts
         
-    except Exception as e:
-        print(f"[错误] 阶段 1 发生致命错误: {e}")
-        return
-    
-    # --- 2. 阶段 A: 异步并发下载历史分片 (0 到 N) ---
+        if keyframe:
+            self.keyframes.append((offset, pts))
+
+def index_path_for(ts_path):
+    """TS 文件对应的旁路索引路径"""
+    return ts_path + ".idx.json"
+
+def save_ts_index(index, ts_path):
+    with open(index_path_for(ts_path), 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+def load_ts_index(ts_path):
+    """读取旁路索引；索引不存在或与文件大小不符时返回 None (TS 文件不存在时抛出 FileNotFoundError)"""
+    try:
+        with open(index_path_for(ts_path), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if index.get("file_size") != os.path.getsize(ts_path):
+        return None
+    return index
+
+def index_ts_file(ts_path, chunk_size=TS_PACKET_SIZE * 8192, start_time=None):
+    """
+    一次顺序扫描已有的 TS 文件，构建并保存旁路索引。
+    文件中没有分片边界，按关键帧 (GOP) 自动分段；提供 start_time (文件开头的墙上时间，UNIX 时间戳) 时
+    可按墙上时间剪辑。
+    """
+    builder = TsIndexBuilder(segment_at_keyframes=True)
+    if start_time is not None:
+        builder.begin_segment(sequence=0, wall_time=start_time)
+    with open(ts_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            builder.feed(chunk)
+    index = builder.finish()
+    save_ts_index(index, ts_path)
+    return index
+
+def segment_start_times(segments):
+    """
+    返回每个分片起点相对第一个分片的秒数，逐个分片累加:
+    与下一个分片的 PTS 连续时取两者 PTS 之差，PTS 跳变 (不连续、推流重启、历史与实时部分拼接) 时
+    取分片时长 (没有时长时取分片内的 PTS 跨度)，因此结果单调递增。
+    """
+    starts = []
+    position = 0.0
+    for i, segment in enumerate(segments):
+        starts.append(position)
+        pts_start = segment["pts_start"]
+        span = (segment["pts_end"] - pts_start) / 90000 if pts_start is not None else 0.0
+        step = segment.get("duration") or span
+        following = segments[i + 1]["pts_start"] if i + 1 < len(segments) else None
+        if pts_start is not None and following is not None and 0 < following - segment["pts_end"] <= MAX_PTS_GAP:
+            step = (following - pts_start) / 90000
+        position += max(step, span)
+    return starts
+
+def keyframe_times(index, wall_clock=False):
+    """
+    返回所有关键帧的时间: 默认为相对第一个关键帧的秒数 (按 segment_start_times 逐分片累加，PTS 重置时仍单调递增)；
+    wall_clock 为 True 时为墙上时间 (由所在分片的 wall_time 推算)，无法计算的关键帧为 None。
+    """
+    keyframes = index["keyframes"]
+    segments = index["segments"]
+    starts = segment_start_times(segments)
     
-    print(f"\n--- 阶段 2/3: 异步并发下载历史分片 (索引 0 到 {last_index}) ---")
-    total_segments = last_index + 1
-    print(f"[信息] 将使用 asyncio 并发下载 {total_segments} 个历史分片 (重试 3 次，支持断点续传)。")
+    # 关键帧和分片都按偏移有序，一次归并即可找到每个关键帧所在的分片
+    times = []
+    position = -1
+    for offset, pts in keyframes:
+        while position + 1 < len(segments) and segments[position + 1]["offset"] <= offset:
+            position += 1
+        segment = segments[position] if position >= 0 else None
+        if segment is None or segment["pts_start"] is None:
+            # 不属于任何分片 (没有分片信息的索引)，按 PTS 相对第一个关键帧计算
+            times.append(None if wall_clock else (pts - keyframes[0][1]) / 90000)
+        elif wall_clock:
+            wall_time = segment["wall_time"]
+            times.append(None if wall_time is None else wall_time + (pts - segment["pts_start"]) / 90000)
+        else:
+            times.append(starts[position] + (pts - segment["pts_start"]) / 90000)
     
-    # 2.1 准备下载任务列表
-    tasks = []
-    for i in range(total_segments):
-        ts_url = f"{base_prefix}_{i}{url_suffix}"
-        ts_local_path = os.path.join(temp_dir, f"segment_{i}.ts")
-        tasks.append(async_download_segment(None, ts_url, ts_local_path, cookie, max_retries=3))
+    if not wall_clock and times:
+        first = times[0]
+        times = [t - first for t in times]
+    return times
+
+def extract_clip(ts_path, index, start, end, output_path, wall_clock=False, chunk_size=1024 * 1024):
+    """
+    利用旁路索引从 TS 文件中直接按字节复制 [start, end) 时间段 (不重新编码)。
+    起点对齐到不晚于 start 的最近关键帧，终点对齐到不早于 end 的第一个关键帧。
+    片段开头写入原文件的 PAT/PMT，保证可以独立播放。
+    返回实际写入的字节数。end 不晚于 start 时抛出 ValueError。
+    """
+    if end <= start:
+        raise ValueError("结束时间必须晚于开始时间")
+    keyframes = index["keyframes"]
+    if not keyframes:
+        raise ValueError("索引中没有关键帧")
     
-    # 2.2 运行异步下载任务并监控进度
-    results = []
-    completed_count = 0
-    downloaded_count = 0
-    skipped_count = 0
+    times = keyframe_times(index, wall_clock)
+    if any(t is None for t in times):
+        raise ValueError("索引中没有墙上时间信息，请使用相对时间")
     
-    start_time = time.time()
+    first = max(bisect.bisect_right(times, start) - 1, 0)
+    last = bisect.bisect_left(times, end)
+    start_offset = keyframes[first][0]
+    end_offset = keyframes[last][0] if last < len(keyframes) else index["file_size"]
     
-    for f in asyncio.as_completed(tasks):
-        # 接收结果: success, path, skipped
-        success, path, skipped = await f
-        
-        results.append((success, path))
-        completed_count += 1
-        
-        if success:
-            if skipped:
-                skipped_count += 1
-            else:
-                downloaded_count += 1
+    written = 0
+    with open(ts_path, 'rb') as src, open(output_path, 'wb') as out_file:
+        for psi_offset in (index["pat_offset"], index["pmt_offset"]):
+            if psi_offset is not None and psi_offset < start_offset:
+                src.seek(psi_offset)
+                written += out_file.write(src.read(TS_PACKET_SIZE))
         
-        # 实时打印进度
-        time_elapsed = time.time() - start_time
-        download_speed = (downloaded_count / time_elapsed) if time_elapsed > 0 and downloaded_count > 0 else 0
-        
-        # 历史分片进度条
-        history_progress_text = display_progress_bar(
-            f"历史分片 (D: {downloaded_count}, S: {skipped_count}, {download_speed:.1f} seg/s)", 
-            completed_count, 
-            total_segments, 
-            bar_length=15
-        )
-        
-        # FFmpeg 状态 (简化)
-        ffmpeg_status_text = "实时下载 [FFmpeg]: 正在准备..."
-        
-        # 清除当前行并重新打印统一进度条
-        print(f"\r{history_progress_text} | {ffmpeg_status_text}", end='', flush=True)
+        src.seek(start_offset)
+        remaining = end_offset - start_offset
+        while remaining > 0:
+            chunk = src.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            written += out_file.write(chunk)
+            remaining -= len(chunk)
+    return written
+
+def parse_extract_time(value):
+    """
+    解析剪辑时间: "YYYY-MM-DDTHH:MM:SS" 为墙上时间，"HH:MM:SS" / "MM:SS" / 秒数为相对时间。
+    返回 (是否为墙上时间, 数值)。
+    """
+    if 'T' in value:
+        return True, datetime.datetime.fromisoformat(value).timestamp()
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return False, seconds
+
+def perform_index(ts_path, start_text=None):
+    """命令行索引入口: start_text 为文件开头的墙上时间 (YYYY-MM-DDTHH:MM:SS)，提供时可按墙上时间剪辑"""
+    start_time = None
+    if start_text:
+        try:
+            start_time = datetime.datetime.fromisoformat(start_text).timestamp()
+        except ValueError:
+            print("[错误] 开始时间格式无效，应为 YYYY-MM-DDTHH:MM:SS。")
+            return
+    try:
+        index = index_ts_file(ts_path, start_time=start_time)
+    except FileNotFoundError:
+        print(f"[错误] 文件不存在: {ts_path}")
+        return
+    except OSError as e:
+        print(f"[错误] 无法读取或写入索引: {e}")
+        return
+    print(f"[成功] 已索引 {len(index['keyframes'])} 个关键帧、{len(index['segments'])} 个分段: {index_path_for(ts_path)}")
 
-    # 下载完成后，打印最终进度
-    history_progress_text = display_progress_bar(
-        f"历史分片 (完成 D:{downloaded_count}, S:{skipped_count})", 
-        total_segments, 
-        total_segments, 
-        bar_length=15
-    )
-    print(f"\r{history_progress_text}", end='\n', flush=True)
+def perform_extract(ts_path, start_text, end_text, output_path=None):
+    """命令行剪辑入口: 必要时先建立索引，再按时间段复制片段"""
+    try:
+        start_wall, start = parse_extract_time(start_text)
+        end_wall, end = parse_extract_time(end_text)
+    except ValueError:
+        print("[错误] 时间格式无效。")
+        return
+    if start_wall != end_wall:
+        print("[错误] 起止时间必须同为相对时间或同为墙上时间。")
+        return
     
-    # 2.3 历史分片合并
-    history_segments_count = sum(1 for success, path in results if success)
+    try:
+        index = load_ts_index(ts_path)
+        if index is None:
+            print(f"[信息] 未找到有效索引，正在扫描 {ts_path} ...")
+            index = index_ts_file(ts_path)
+    except FileNotFoundError:
+        print(f"[错误] 文件不存在: {ts_path}")
+        return
+    except OSError as e:
+        print(f"[错误] 无法读取或写入索引: {e}")
+        return
     
-    if history_segments_count == 0:
-        print("[警告] 没有成功下载任何历史分片，跳过历史合并。")
-        download_success = False
-    else:
-        file_list_path = os.path.join(temp_dir, "history_filelist.txt")
-        
-        with open(file_list_path, 'w', encoding='utf-8') as filelist_f:
-            # 必须按索引顺序合并
-            for i in range(total_segments):
-                seg_name = f"segment_{i}.ts"
-                seg_path = os.path.join(temp_dir, seg_name)
-                if os.path.exists(seg_path):
-                    # 在FFmpeg的concat文件中使用正斜杠（跨平台兼容）
-                    # 或者直接使用文件名（因为FFmpeg会在同一目录下查找）
-                    filelist_f.write(f"file '{seg_name}'\n")
-        
-        try:
-            # 使用 FFmpeg concat 协议合并历史分片
-            history_merge_command = [
-                "ffmpeg", 
-                "-f", "concat", 
-                "-safe", "0", 
-                "-i", file_list_path, 
-                "-c", "copy",
-                history_output_file
-            ]
-            
-            original_cwd = os.getcwd()
-            os.chdir(temp_dir)
-            subprocess.run(history_merge_command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-            os.chdir(original_cwd)
-            
-            print(f"[成功] 历史分片合并为 {os.path.basename(history_output_file)} 完成。")
-        except subprocess.CalledProcessError as e:
-            print(f"[严重错误] 历史分片合并失败。中止。")
-            print(e.stderr.decode())
-            download_success = False
-        except Exception as e:
-            print(f"[严重错误] 历史分片合并时发生未知错误: {e}")
-            download_success = False
+    if not output_path:
+        base_name = os.path.splitext(ts_path)[0]
+        output_path = f"{base_name}_clip_{sanitize_filename(start_text)}-{sanitize_filename(end_text)}.ts"
+    try:
+        written = extract_clip(ts_path, index, start, end, output_path, wall_clock=start_wall)
+    except ValueError as e:
+        print(f"[错误] {e}")
+        return
+    except OSError as e:
+        print(f"[错误] 无法写入片段: {e}")
+        return
+    print(f"[成功] 已导出 {written / 1024 ** 2:.1f} MB 到: {output_path}")
+
+# --- 开播监控与自动录制 ---
+
+def is_recordable_playlist(content):
+    """
+    判断媒体播放列表是否已可录制 (至少包含一个分片)。
+    主播放列表在开播前就可能存在，需先取出子流播放列表再判断。
+    """
+    return content.lstrip().startswith('#EXTM3U') and '#EXTINF' in content
+
+def select_stream_from_playlist(content, url):
+    """从播放列表中选择要录制的流: 主播放列表取最高码率，媒体播放列表直接使用自身"""
+    streams = parse_m3u8_string(content, base_url=url)
+    if not streams:
+        return VideoStream("N/A", "0.00 Mbps", url)
+    # 录制时仍请求主播放列表，由 async_perform_download 根据分辨率和码率匹配子流
+    best = max(streams, key=lambda s: float(s.bandwidth.split()[0]))
+    return VideoStream(best.resolution, best.bandwidth, url)
+
+class WatchedChannel:
+    """开播监控中的一个频道"""
+    def __init__(self, url, start_at=None, name=None, cookie=None):
+        self.url = url
+        self.start_at = start_at  # 预定开播时间 (UNIX 时间戳)，None 表示未知
+        self.name = name
+        self.cookie = cookie
+        self.state = "waiting"    # waiting -> recording -> done (未录制到内容时回到 waiting)
+        self.etag = None
+        self.last_modified = None
+        self.master_playlist = None  # 上次获取到的主播放列表，条件请求返回 304 时复用
+        self.backoff = 0
+        self.polls = 0
 
+    def __str__(self):
+        return self.name or self.url[:60]
 
-    # --- 3. 阶段 B: FFmpeg 下载后续直播分片 ($N+1$ 到 End) ---
+class LiveRecordingScheduler:
+    """
+    在单个事件循环中同时监控大量频道，开播后立即启动录制任务。
 
-    if download_success:
-        print(f"\n--- 阶段 3/3: 下载后续直播分片 ({last_index + 1} 到 End) ---")
-        print("[信息] 使用 FFmpeg 实时下载 (内置重试机制: -reconnect, 间隔 5s)。")
+    - 所有频道共享一个按时间排序的堆，只有一个调度协程，空闲频道不占用任务或线程
+    - 轮询使用 If-None-Match / If-Modified-Since 条件请求，并发请求数受 max_concurrent_polls 限制
+    - 未开播时轮询间隔从 min_interval 按 backoff_factor 递增到 max_interval
+    - 预定开播时间前 lead_time 秒到开播后 tight_window 秒内，改为每 tight_interval 秒轮询
+    - 检测到有效播放列表 (主播放列表要求选中的子流已有分片) 后调用 job_factory(channel, stream) 得到协程并启动
+    - 协程返回 False 或抛出异常时视为没有录到内容 (例如刚开播就断流)，频道回到等待状态继续轮询
+    """
+    def __init__(self, job_factory=None, output_dir=None, min_interval=30, max_interval=600,
+                 backoff_factor=1.5, tight_interval=3, lead_time=300, tight_window=900,
+                 max_concurrent_polls=8, timeout=10, segment_store=None, job_workers=16):
+        self.job_factory = job_factory or self.default_job
+        self.output_dir = output_dir or os.getcwd()
+        self.segment_store = segment_store  # 默认录制任务共享的 SegmentStore
+        self.job_workers = job_workers      # 默认录制任务各自的下载线程数
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.tight_interval = tight_interval
+        self.lead_time = lead_time
+        self.tight_window = tight_window
+        self.max_concurrent_polls = max_concurrent_polls
+        self.timeout = timeout
         
-        download_command_1 = ["ffmpeg"]
+        self.channels = []
+        self._heap = []           # (下次轮询时间, 序号, 频道)
+        self._counter = 0
+        self._jobs = set()
+        self._wakeup = None
+        self._stopping = False
+
+    def add_channel(self, url, start_at=None, name=None, cookie=None):
+        """添加要监控的频道，可在 run() 运行期间调用"""
+        channel = WatchedChannel(url, start_at, name, cookie)
+        self.channels.append(channel)
+        self._schedule(channel, time.time())
+        return channel
+
+    def stop(self):
+        """停止监控。已启动的录制任务不受影响，run() 等待它们结束后返回"""
+        self._stopping = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _schedule(self, channel, when):
+        self._counter += 1
+        heapq.heappush(self._heap, (when, self._counter, channel))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _next_delay(self, channel, now):
+        """计算频道下一次轮询的间隔"""
+        if channel.start_at is not None:
+            if channel.start_at - self.lead_time <= now <= channel.start_at + self.tight_window:
+                return self.tight_interval
         
-        if cookie:
-            download_command_1.extend(["-headers", f"Cookie: {cookie}"])
-            
-        # 设置 FFmpeg 内置重试机制
-        download_command_1.extend([
-            "-live_start_index", "-1", 
-            "-reconnect", "1",
-            "-reconnect_streamed", "1", 
-            "-reconnect_delay_max", "5", 
-            "-i", final_stream_url, 
-            "-c", "copy",
-            live_output_file
-        ])
+        channel.backoff = min(self.max_interval, channel.backoff * self.backoff_factor) if channel.backoff else self.min_interval
+        # 加入少量抖动，避免大量频道在同一时刻集中轮询
+        delay = channel.backoff * random.uniform(0.9, 1.1)
+        if channel.start_at is not None and now < channel.start_at - self.lead_time:
+            # 不要错过密集轮询窗口的开始
+            delay = min(delay, channel.start_at - self.lead_time - now)
+        return delay
 
+    def _poll(self, channel):
+        """
+        同步条件请求播放列表 (在线程池中运行)。
+        返回播放列表内容，未开播或未变化时返回 None。
+        主播放列表还要请求码率最高的子流，子流已有分片才算开播。
+        """
+        req = urllib.request.Request(channel.url)
+        if channel.cookie:
+            req.add_header('Cookie', channel.cookie)
+        if channel.etag:
+            req.add_header('If-None-Match', channel.etag)
+        if channel.last_modified:
+            req.add_header('If-Modified-Since', channel.last_modified)
+        
         try:
-            print("--- FFmpeg 实时下载开始 (按 Q 键停止下载) ---")
-            subprocess.run(download_command_1)
-            print("--- 实时下载命令执行完毕 ---")
-        except Exception as e:
-            print(f"[错误] 实时下载过程中发生错误: {e}")
-
-    # --- 4. 最终合并 (Stage C) ---
-    
-    history_exists = os.path.exists(history_output_file) and os.path.getsize(history_output_file) > 0
-    live_exists = os.path.exists(live_output_file) and os.path.getsize(live_output_file) > 0
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                content = response.read().decode('utf-8', errors='replace')
+                channel.etag = response.headers.get('ETag')
+                channel.last_modified = response.headers.get('Last-Modified')
+        except urllib.error.HTTPError as e:
+            # 304 未变化；404/403 等说明尚未开播
+            e.close()
+            if e.code != 304 or channel.master_playlist is None:
+                return None
+            # 主播放列表未变化，但子流可能已经开始产生分片
+            content = channel.master_playlist
+        except Exception:
+            return None
+        
+        if '#EXT-X-STREAM-INF' not in content:
+            return content if is_recordable_playlist(content) else None
+        
+        channel.master_playlist = content
+        streams = parse_m3u8_string(content, base_url=channel.url)
+        if not streams:
+            return None
+        try:
+            variant = http_get(highest_bandwidth_variant(streams).url, channel.cookie, self.timeout)
+        except Exception:
+            return None
+        return content if is_recordable_playlist(variant.decode('utf-8', errors='replace')) else None
 
-    if history_exists or live_exists:
-        # ... (与上个版本相同的最终合并逻辑) ...
-        if history_exists and live_exists:
-            print("\n--- 最终合并: 合并历史和实时部分 ---")
-            
-            final_file_list_path = os.path.join(temp_dir, "final_merge_filelist.txt")
-            with open(final_file_list_path, 'w', encoding='utf-8') as f:
-                f.write(f"file '{os.path.basename(history_output_file)}'\n")
-                f.write(f"file '{os.path.basename(live_output_file)}'\n")
-            
-            final_merge_command = [
-                "ffmpeg", 
-                "-f", "concat", 
-                "-safe", "0", 
-                "-i", final_file_list_path, 
-                "-c", "copy",
-                final_output_filename
-            ]
-            
-            try:
-                original_cwd = os.getcwd()
-                os.chdir(temp_dir)
-                subprocess.run(final_merge_command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-                os.chdir(original_cwd)
-                print(f"\n[成功] 所有部分已合并并保存到最终文件: {final_output_filename}")
-            except subprocess.CalledProcessError as e:
-                print(f"[严重错误] 最终合并失败。请检查FFmpeg输出。")
-                print(e.stderr.decode())
+    async def _check_channel(self, channel, semaphore, executor):
+        async with semaphore:
+            content = await asyncio.get_running_loop().run_in_executor(executor, self._poll, channel)
+        channel.polls += 1
         
-        elif history_exists:
-            print(f"\n[信息] 未检测到后续直播内容。直接将历史文件移动到: {final_output_filename}")
-            try:
-                shutil.move(history_output_file, final_output_filename)
-                print(f"[成功] 文件保存到: {final_output_filename}")
-            except Exception as e:
-                print(f"[错误] 无法移动历史文件: {e}")
+        if self._stopping:
+            return
+        if content is None:
+            self._schedule(channel, time.time() + self._next_delay(channel, time.time()))
+            return
         
-        elif live_exists:
-            print(f"\n[信息] 历史下载失败，只将直播部分移动到: {final_output_filename}")
-            try:
-                shutil.move(live_output_file, final_output_filename)
-                print(f"[成功] 文件保存到: {final_output_filename}")
-            except Exception as e:
-                print(f"[错误] 无法移动直播文件: {e}")
+        channel.state = "recording"
+        stream = select_stream_from_playlist(content, channel.url)
+        print(f"\n[开播] {channel} 已开播 ({stream.resolution} @ {stream.bandwidth})，开始录制。")
+        job = asyncio.ensure_future(self.job_factory(channel, stream))
+        self._jobs.add(job)
+        job.add_done_callback(lambda f, channel=channel: self._job_done(channel, f))
 
-    # --- 5. 清理 ---
-    try:
-        if os.path.isdir(temp_dir):
-            shutil.rmtree(temp_dir)
-            print(f"\n[清理] 已移除临时目录: {temp_dir}")
-    except Exception as e:
-        print(f"[警告] 无法自动清理临时目录，请手动删除: {temp_dir} ({e})")
+    def _job_done(self, channel, future):
+        self._jobs.discard(future)
+        recorded = True
+        if not future.cancelled():
+            if future.exception() is not None:
+                print(f"\n[错误] {channel} 录制任务出错: {future.exception()}")
+                recorded = False
+            elif future.result() is False:
+                recorded = False
         
-    print("\n程序运行结束。")
+        if recorded or self._stopping:
+            channel.state = "done"
+        else:
+            # 没有录到内容: 回到等待状态，按退避间隔继续轮询
+            print(f"\n[信息] {channel} 未录制到内容，继续监控。")
+            channel.state = "waiting"
+            self._schedule(channel, time.time() + self._next_delay(channel, time.time()))
+        if self._wakeup is not None:
+            self._wakeup.set()
 
-def perform_download(stream, cookie=None, suggested_filename=None):
+    async def default_job(self, channel, stream):
+        """
+        默认录制任务: 直接在调度循环中运行 async_perform_download。
+        FFmpeg 以异步子进程运行；网络请求使用本任务单独的线程池 (job_workers 个线程)，
+        一个频道的大量历史分片不会占满其他频道的线程。返回是否生成了录制文件。
+        """
+        name = channel.name or "HLS_Stream"
+        filename = sanitize_filename(f"{name}_{stream.resolution}_{time.strftime('%Y%m%d_%H%M%S')}") + ".ts"
+        output_filename = os.path.join(self.output_dir, filename)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.job_workers)
+        try:
+            await async_perform_download(stream, channel.cookie, output_filename=output_filename,
+                                         segment_store=self.segment_store, executor=executor)
+        finally:
+            # 不等待仍在进行的请求 (任务被取消时不阻塞事件循环)
+            executor.shutdown(wait=False, cancel_futures=True)
+        return os.path.exists(output_filename)
+
+    async def run(self, stop_when_idle=True):
+        """
+        运行调度循环。stop_when_idle 为 True 时，所有频道都已录制且录制任务结束后返回。
+        调用 stop() 后不再轮询，等待已启动的录制任务结束后返回。
+        """
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        semaphore = asyncio.Semaphore(self.max_concurrent_polls)
+        checks = set()
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrent_polls) as executor:
+            while not self._stopping:
+                if not self._heap:
+                    if stop_when_idle and not self._jobs and not checks:
+                        break
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                
+                when = self._heap[0][0]
+                delay = when - time.time()
+                if delay > 0:
+                    # 睡到最早的频道到期，期间新增频道或任务结束会提前唤醒
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                
+                _, _, channel = heapq.heappop(self._heap)
+                check = asyncio.ensure_future(self._check_channel(channel, semaphore, executor))
+                checks.add(check)
+                check.add_done_callback(checks.discard)
+                check.add_done_callback(lambda f: self._wakeup.set())
+            
+            if checks:
+                await asyncio.gather(*checks, return_exceptions=True)
+        
+        if self._jobs:
+            await asyncio.gather(*self._jobs, return_exceptions=True)
+
+def load_watch_list(path):
     """
-    同步调用 async_perform_download，作为程序的主要入口。
+    读取监控列表文件，每行格式: URL [开播时间 YYYY-MM-DDTHH:MM] [名称]
+    以 # 开头的行为注释。
     """
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(maxsplit=2)
+            url = fields[0]
+            start_at = None
+            name_fields = fields[1:]
+            if name_fields:
+                try:
+                    start_at = datetime.datetime.fromisoformat(name_fields[0]).timestamp()
+                    name_fields = name_fields[1:]
+                except ValueError:
+                    pass
+            name = " ".join(name_fields) or None
+            entries.append((url, start_at, name))
+    return entries
+
+def perform_watch(watch_list_path, cookie=None):
+    """
+    监控列表中的所有频道，开播后自动录制到当前目录。
+    """
+    if not check_ffmpeg(): return
+    
     try:
-        # 使用 asyncio.run 执行异步函数
-        asyncio.run(async_perform_download(stream, cookie, suggested_filename))
-    except KeyboardInterrupt:
-        print("\n[中断] 用户手动停止下载。")
+        entries = load_watch_list(watch_list_path)
     except Exception as e:
-        print(f"\n[致命错误] 程序运行出错: {e}")
+        print(f"[错误] 无法读取监控列表 {watch_list_path}: {e}")
+        return
+    if not entries:
+        print("[错误] 监控列表为空。")
+        return
+    
+    segment_store = open_segment_store_from_env()
+    scheduler = LiveRecordingScheduler(segment_store=segment_store)
+    for url, start_at, name in entries:
+        scheduler.add_channel(url, start_at=start_at, name=name, cookie=cookie)
+    print(f"[信息] 正在监控 {len(entries)} 个频道，开播后自动录制 (按 Ctrl+C 停止)。")
+    
+    try:
+        asyncio.run(scheduler.run())
+    except KeyboardInterrupt:
+        print("\n[中断] 用户手动停止监控。")
+    finally:
+        if segment_store is not None:
+            segment_store.close()
 
 # --- 辅助函数 (本地播放和推流) ---
 
@@ -580,17 +2866,34 @@ def perform_livestream(stream, cookie=None):
         print("[错误] 推流密钥不能为空，操作取消。")
         return
     
-    # 构建 RTMP 推流地址 (无鉴权)
+    # 构建 RTMP 推流地址。阿里云推流域名和播放域名分别配置鉴权 KEY:
+    # 设置 ALIYUN_AUTH_KEY 时推流地址使用 A 类鉴权，设置 ALIYUN_PLAY_AUTH_KEY 时播放地址使用 A 类鉴权
     rtmp_url = f"rtmp://{PUSH_DOMAIN}/{APP_NAME}/{stream_key}"
+    play_urls = [
+        ("RTMP 播放: ", f"rtmp://{PLAY_DOMAIN}/{APP_NAME}/{stream_key}"),
+        ("HLS 播放:  ", f"http://{PLAY_DOMAIN}/{APP_NAME}/{stream_key}.m3u8"),
+        ("FLV 播放:  ", f"http://{PLAY_DOMAIN}/{APP_NAME}/{stream_key}.flv"),
+    ]
+    expire_in = int(os.environ.get("ALIYUN_AUTH_EXPIRE", "3600"))
+    auth_key = os.environ.get("ALIYUN_AUTH_KEY")
+    play_auth_key = os.environ.get("ALIYUN_PLAY_AUTH_KEY")
+    if auth_key:
+        rtmp_url = UrlSigner(auth_key, "A").sign(rtmp_url, expire_in=expire_in)
+    if play_auth_key:
+        signed_play_urls = UrlSigner(play_auth_key, "A").sign_many([url for _, url in play_urls], expire_in=expire_in)
+        play_urls = [(label, url) for (label, _), url in zip(play_urls, signed_play_urls)]
     
     print(f"\n[推流] 正在将 HLS 流 ({stream.resolution} @ {stream.bandwidth}) 推送到阿里云")
     print(f"[配置] 推流域名: {PUSH_DOMAIN}")
     print(f"[配置] 应用名称: {APP_NAME}")
     print(f"[配置] 流名称: {stream_key}")
+    if auth_key:
+        print(f"[配置] 推流地址已启用 A 类鉴权，有效期 {expire_in} 秒")
+    if play_auth_key:
+        print(f"[配置] 播放地址已启用 A 类鉴权，有效期 {expire_in} 秒")
     print(f"\n[注意] 推流开始后，您可以通过以下地址观看：")
-    print(f"       RTMP 播放: rtmp://{PLAY_DOMAIN}/{APP_NAME}/{stream_key}")
-    print(f"       HLS 播放:  http://{PLAY_DOMAIN}/{APP_NAME}/{stream_key}.m3u8")
-    print(f"       FLV 播放:  http://{PLAY_DOMAIN}/{APP_NAME}/{stream_key}.flv")
+    for label, url in play_urls:
+        print(f"       {label}{url}")
 
     # 构建推流命令 (使用流复制，无需重新编码)
     livestream_command = [
@@ -706,11 +3009,12 @@ def handle_user_choice(streams, cookie=None, suggested_filename=None):
     print("[2] 本地播放 (PotPlayer/VLC)")
     print("[3] 推流直播 (需要 FFmpeg)")
     print("[4] 查看/下载 M3U8 列表")
-    print("[5] 退出")
+    print("[5] 下载并开启直播回看 (DVR，随时导出片段)")
+    print("[6] 退出")
     print("----------------------------")
 
     while True:
-        operation = input("请输入操作编号 (1-5): ")
+        operation = input("请输入操作编号 (1-6): ")
         if operation == '1':
             perform_download(selected_stream, cookie, suggested_filename)
             break
@@ -724,6 +3028,9 @@ def handle_user_choice(streams, cookie=None, suggested_filename=None):
             view_or_download_m3u8(selected_stream, cookie)
             break
         elif operation == '5':
+            perform_dvr(selected_stream, cookie, suggested_filename)
+            break
+        elif operation == '6':
             print("操作取消，程序退出。")
             break
         else:
@@ -732,6 +3039,21 @@ def handle_user_choice(streams, cookie=None, suggested_filename=None):
 # --- 主执行逻辑 ---
 if __name__ == "__main__":
     
+    # 开播监控模式: python HLS_Stream_Interactive.py --watch channels.txt
+    if len(sys.argv) >= 3 and sys.argv[1] == "--watch":
+        perform_watch(sys.argv[2], cookie=os.environ.get("HLS_COOKIE"))
+        sys.exit(0)
+    
+    # 为已有录像建立剪辑索引: python HLS_Stream_Interactive.py --index video.ts [文件开头的墙上时间]
+    if len(sys.argv) >= 3 and sys.argv[1] == "--index":
+        perform_index(*sys.argv[2:4])
+        sys.exit(0)
+    
+    # 快速剪辑: python HLS_Stream_Interactive.py --extract video.ts <开始> <结束> [输出文件]
+    if len(sys.argv) >= 5 and sys.argv[1] == "--extract":
+        perform_extract(*sys.argv[2:6])
+        sys.exit(0)
+    
     print("=========================================================")
     print("HLS M3U8 视频流解析工具")
     print("=========================================================")
@@ -0,0 +1,217 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import HLS_Stream_Interactive as hls
+
+PMT_PID = 0x1000
+VIDEO_PID = 0x100
+FRAME_TICKS = 3600  # 25 fps, 90kHz
+GOP = 25
+
+
+# --- 合成 TS 样本 ---
+
+def ts_packet(pid, payload, pusi=False, random_access=False):
+    header = bytes([0x47, (0x40 if pusi else 0) | (pid >> 8), pid & 0xFF])
+    if random_access:
+        # 自适应字段: random_access_indicator，其余用填充字节补齐
+        stuffing = 184 - 2 - len(payload)
+        body = bytes([1 + stuffing, 0x40]) + b'\xff' * stuffing
+        return header + b'\x30' + body + payload
+    if len(payload) < 184:
+        stuffing = 184 - 1 - len(payload)
+        body = bytes([stuffing]) + (b'\x00' + b'\xff' * (stuffing - 1) if stuffing else b'')
+        return header + b'\x30' + body + payload
+    return header + b'\x10' + payload
+
+
+def pat_packet():
+    section = bytes([0x00, 0xB0, 13, 0, 1, 0xC1, 0, 0, 0, 1, 0xE0 | (PMT_PID >> 8), PMT_PID & 0xFF]) + b'\0' * 4
+    return ts_packet(0, b'\0' + section, pusi=True)
+
+
+def pmt_packet(stream_type=0x1B):
+    section = bytes([0x02, 0xB0, 18, 0, 1, 0xC1, 0, 0, 0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0,
+                     stream_type, 0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0]) + b'\0' * 4
+    return ts_packet(PMT_PID, b'\0' + section, pusi=True)
+
+
+def encode_pts(pts):
+    return bytes([0x21 | ((pts >> 29) & 0x0E), (pts >> 22) & 0xFF, 0x01 | ((pts >> 14) & 0xFE),
+                  (pts >> 7) & 0xFF, 0x01 | ((pts << 1) & 0xFE)])
+
+
+def video_frame(pts, nal_units, random_access=False):
+    """一个视频 PES (AUD + 给定的 NAL 单元)，拆分为多个 TS 包"""
+    es = b'\0\0\0\x01\x09\xf0' + b''.join(b'\0\0\x01' + nal + b'\xaa' * 200 for nal in nal_units)
+    pes = b'\0\0\x01\xe0\0\0\x80\x80\x05' + encode_pts(pts) + es
+    first = 170 if random_access else 184
+    packets = ts_packet(VIDEO_PID, pes[:first], pusi=True, random_access=random_access)
+    rest = pes[first:]
+    while rest:
+        packets += ts_packet(VIDEO_PID, rest[:184])
+        rest = rest[184:]
+    return packets
+
+
+def h264_segment(first_frame, count, start_pts=0):
+    """每 GOP 帧一个 IDR 帧，非关键帧以 SPS/PPS 开头 (不应被当作关键帧)"""
+    data = pat_packet() + pmt_packet()
+    for number in range(first_frame, first_frame + count):
+        pts = (start_pts + number * FRAME_TICKS) % hls.PTS_WRAP
+        if number % GOP == 0:
+            data += video_frame(pts, [b'\x67', b'\x68', b'\x65'])
+        else:
+            data += video_frame(pts, [b'\x67', b'\x68', b'\x41'])
+    return data
+
+
+def build_index(segments, wall_times=None, chunk_size=1000):
+    builder = hls.TsIndexBuilder()
+    for number, data in enumerate(segments):
+        wall_time = wall_times[number] if wall_times else None
+        builder.begin_segment(sequence=number, duration=2.0, wall_time=wall_time)
+        for start in range(0, len(data), chunk_size):
+            builder.feed(data[start:start + chunk_size])
+    return builder.finish()
+
+
+class TsParsingTest(unittest.TestCase):
+    def test_pat_pmt(self):
+        index = build_index([h264_segment(0, 10)])
+        self.assertEqual(index["video_pid"], VIDEO_PID)
+        self.assertEqual(index["codec"], "h264")
+        self.assertEqual(index["pat_offset"], 0)
+        self.assertEqual(index["pmt_offset"], hls.TS_PACKET_SIZE)
+
+    def test_read_pes_pts(self):
+        for pts in (0, 90000, hls.PTS_WRAP - 1):
+            payload = b'\0\0\x01\xe0\0\0\x80\x80\x05' + encode_pts(pts)
+            self.assertEqual(hls.read_pes_pts(payload), pts)
+        self.assertIsNone(hls.read_pes_pts(b'\0\0\x01\xe0\0\0\x80\x00\x00' + b'\0' * 5))
+
+    def test_keyframe_nal_types(self):
+        self.assertTrue(hls.payload_is_keyframe(b'\0\0\x01\x67..\0\0\x01\x65', "h264"))
+        self.assertFalse(hls.payload_is_keyframe(b'\0\0\x01\x67..\0\0\x01\x41', "h264"))
+        self.assertIsNone(hls.payload_is_keyframe(b'\0\0\x01\x67..\0\0\x01\x68', "h264"))
+        self.assertTrue(hls.payload_is_keyframe(b'\0\0\x01\x40\x01\0\0\x01\x26\x01', "hevc"))  # VPS + IDR_W_RADL
+        self.assertFalse(hls.payload_is_keyframe(b'\0\0\x01\x40\x01\0\0\x01\x02\x01', "hevc"))  # VPS + TRAIL_R
+        self.assertIsNone(hls.payload_is_keyframe(b'\0\0\x01\x00', "mpeg2"))
+
+    def test_keyframes_ignore_parameter_sets(self):
+        index = build_index([h264_segment(0, 60)])
+        self.assertEqual([pts for _, pts in index["keyframes"]], [0, GOP * FRAME_TICKS, 2 * GOP * FRAME_TICKS])
+
+    def test_random_access_fallback(self):
+        # 编码片不在第一个 TS 包中时，按 random_access_indicator 判断
+        long_sei = [b'\x06' + b'\x55' * 400]
+        data = pat_packet() + pmt_packet()
+        data += video_frame(0, long_sei + [b'\x65'], random_access=True)
+        data += video_frame(FRAME_TICKS, long_sei + [b'\x41'])
+        index = build_index([data])
+        self.assertEqual([pts for _, pts in index["keyframes"]], [0])
+
+    def test_pts_wrap(self):
+        start_pts = hls.PTS_WRAP - 30 * FRAME_TICKS
+        index = build_index([h264_segment(0, 60, start_pts)])
+        times = hls.keyframe_times(index)
+        self.assertEqual(times, [0.0, 1.0, 2.0])
+        self.assertGreater(index["segments"][0]["pts_end"], hls.PTS_WRAP)
+
+    def test_pts_reset(self):
+        # 第三个分片起 PTS 从 0 重新开始 (推流重启)，时间按分片时长继续累加
+        segments = [h264_segment(0, 50), h264_segment(50, 50), h264_segment(0, 50), h264_segment(50, 50)]
+        index = build_index(segments, wall_times=[1000.0, None, None, None])
+        self.assertEqual(hls.keyframe_times(index), [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])
+        self.assertEqual([segment["wall_time"] for segment in index["segments"]], [1000.0, 1002.0, 1004.0, 1006.0])
+        self.assertEqual(hls.keyframe_times(index, wall_clock=True)[4:], [1004.0, 1005.0, 1006.0, 1007.0])
+
+
+class ExtractClipTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "rec.ts")
+        self.segments = [h264_segment(number * 50, 50) for number in range(4)]
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(self.segments))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_segment_offsets(self):
+        index = build_index(self.segments)
+        offset = 0
+        for segment, data in zip(index["segments"], self.segments):
+            self.assertEqual((segment["offset"], segment["length"]), (offset, len(data)))
+            offset += len(data)
+        self.assertEqual(index["file_size"], os.path.getsize(self.path))
+
+    def test_extract_aligns_to_keyframes(self):
+        index = build_index(self.segments)
+        keyframes = index["keyframes"]
+        output = os.path.join(self.directory.name, "clip.ts")
+        # 1.5 秒对齐到 1 秒处的关键帧，4.5 秒对齐到 5 秒处的关键帧
+        written = hls.extract_clip(self.path, index, 1.5, 4.5, output)
+        with open(self.path, 'rb') as f:
+            source = f.read()
+        with open(output, 'rb') as f:
+            clip = f.read()
+        self.assertEqual(written, len(clip))
+        self.assertEqual(clip[:2 * hls.TS_PACKET_SIZE], pat_packet() + pmt_packet())
+        self.assertEqual(clip[2 * hls.TS_PACKET_SIZE:], source[keyframes[1][0]:keyframes[5][0]])
+        clip_index = hls.index_ts_file(output)
+        self.assertEqual(hls.keyframe_times(clip_index), [0.0, 1.0, 2.0, 3.0])
+
+    def test_extract_wall_clock(self):
+        # 只有最后两个分片带墙上时间 (前面的分片已滚出播放列表)，其余按 PTS 推算
+        index = build_index(self.segments, wall_times=[None, None, 1004.0, 1006.0])
+        self.assertEqual([segment["wall_time"] for segment in index["segments"]], [1000.0, 1002.0, 1004.0, 1006.0])
+        output = os.path.join(self.directory.name, "clip.ts")
+        hls.extract_clip(self.path, index, 1001.0, 1003.0, output, wall_clock=True)
+        self.assertEqual(hls.keyframe_times(hls.index_ts_file(output)), [0.0, 1.0])
+
+    def test_scan_segments_at_keyframes(self):
+        index = hls.index_ts_file(self.path, start_time=1000.0)
+        self.assertEqual(len(index["segments"]), len(index["keyframes"]))
+        self.assertEqual(index["segments"][0]["offset"], 0)
+        self.assertEqual(sum(segment["length"] for segment in index["segments"]), os.path.getsize(self.path))
+        self.assertEqual(hls.keyframe_times(index, wall_clock=True)[:3], [1000.0, 1001.0, 1002.0])
+        self.assertEqual(hls.load_ts_index(self.path)["segments"], index["segments"])
+
+    def test_extract_after_pts_reset(self):
+        segments = self.segments[:2] + [h264_segment(0, 50), h264_segment(50, 50)]
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(segments))
+        index = build_index(segments)
+        output = os.path.join(self.directory.name, "clip.ts")
+        hls.extract_clip(self.path, index, 3.0, 6.0, output)
+        with open(self.path, 'rb') as f:
+            source = f.read()
+        with open(output, 'rb') as f:
+            clip = f.read()
+        self.assertEqual(clip[2 * hls.TS_PACKET_SIZE:], source[index["keyframes"][3][0]:index["keyframes"][6][0]])
+
+    def test_extract_empty_range(self):
+        index = build_index(self.segments)
+        output = os.path.join(self.directory.name, "clip.ts")
+        with self.assertRaises(ValueError):
+            hls.extract_clip(self.path, index, 3.0, 3.0, output)
+        self.assertFalse(os.path.exists(output))
+
+    def test_missing_file(self):
+        missing = os.path.join(self.directory.name, "missing.ts")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            hls.perform_index(missing)
+            hls.perform_extract(missing, "0", "1")
+        self.assertEqual(output.getvalue().count("[错误]"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()